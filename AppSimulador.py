@@ -6,6 +6,15 @@ import seaborn as sns
 import datetime
 import sqlite3
 import json
+import os
+import hashlib
+import threading
+import io
+import sys
+import queue
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from tkinter import messagebox
 import matplotlib.ticker as mtick
@@ -69,16 +78,189 @@ class GestorBD:
             )
         ''')
 
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS metricas_producto (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                simulacion_id INTEGER,
+                nombre_producto TEXT,
+                categoria TEXT,
+                demanda REAL,
+                insatisfecha REAL,
+                dias_quiebre INTEGER,
+                tasa_servicio REAL,
+                dias_cobertura REAL,
+                FOREIGN KEY(simulacion_id) REFERENCES simulaciones(id)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS metricas_categoria (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                simulacion_id INTEGER,
+                categoria TEXT,
+                demanda REAL,
+                insatisfecha REAL,
+                dias_quiebre INTEGER,
+                tasa_servicio REAL,
+                dias_cobertura REAL,
+                FOREIGN KEY(simulacion_id) REFERENCES simulaciones(id)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS corridas_multisede (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fecha TIMESTAMP,
+                n_sedes INTEGER,
+                almacen_compartido INTEGER,
+                presupuesto_compartido INTEGER,
+                total_gasto REAL
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fecha TIMESTAMP,
+                simulacion_id INTEGER,
+                corrida_id INTEGER,
+                dia INTEGER,
+                sedes_json TEXT,
+                estado BLOB,
+                FOREIGN KEY(simulacion_id) REFERENCES simulaciones(id),
+                FOREIGN KEY(corrida_id) REFERENCES corridas_multisede(id)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trabajos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tipo TEXT,
+                clave TEXT,
+                parametros_json TEXT,
+                estado TEXT,
+                resultado_json TEXT,
+                error TEXT,
+                creado TIMESTAMP,
+                actualizado TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_clave ON trabajos(clave, estado)")
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS almacenes_resultados (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fecha TIMESTAMP,
+                ruta TEXT,
+                capacidad INTEGER,
+                n_dias INTEGER,
+                productos_json TEXT,
+                n_corridas INTEGER DEFAULT 0,
+                reservadas INTEGER DEFAULT 0
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS lotes_almacen (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                almacen_id INTEGER,
+                fecha TIMESTAMP,
+                inicio INTEGER,
+                cantidad INTEGER,
+                parametros_json TEXT,
+                FOREIGN KEY(almacen_id) REFERENCES almacenes_resultados(id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_lotes_almacen ON lotes_almacen(almacen_id, inicio)")
+
+        # Migración: columnas de sede en bases creadas por versiones anteriores
+        columnas = [row[1] for row in cursor.execute("PRAGMA table_info(simulaciones)")]
+        if "corrida_id" not in columnas:
+            cursor.execute("ALTER TABLE simulaciones ADD COLUMN corrida_id INTEGER REFERENCES corridas_multisede(id)")
+        if "sede" not in columnas:
+            cursor.execute("ALTER TABLE simulaciones ADD COLUMN sede TEXT")
+        if "limite_quincenal" not in columnas:
+            cursor.execute("ALTER TABLE simulaciones ADD COLUMN limite_quincenal REAL")
+        columnas = [row[1] for row in cursor.execute("PRAGMA table_info(detalles_stock)")]
+        if "historia_blob" not in columnas:
+            cursor.execute("ALTER TABLE detalles_stock ADD COLUMN historia_blob BLOB")
+        columnas = [row[1] for row in cursor.execute("PRAGMA table_info(almacenes_resultados)")]
+        if "reservadas" not in columnas:
+            cursor.execute("ALTER TABLE almacenes_resultados ADD COLUMN reservadas INTEGER DEFAULT 0")
+            cursor.execute("UPDATE almacenes_resultados SET reservadas = n_corridas")
+
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_detalles_categoria_sim ON detalles_categoria(simulacion_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_detalles_quincena_sim ON detalles_quincena(simulacion_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_detalles_stock_sim ON detalles_stock(simulacion_id)")
+
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_metricas_producto_sim ON metricas_producto(simulacion_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_metricas_categoria_sim ON metricas_categoria(simulacion_id)")
+
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def decodificar_historia(blob, texto):
+        # Las simulaciones nuevas guardan la historia como float32 binario; las antiguas como JSON
+        if blob is not None: return np.frombuffer(blob, dtype=np.float32)
+        return np.asarray(json.loads(texto), dtype=np.float32)
+
+    @staticmethod
+    def filas_servicio_categoria(metricas):
+        m = metricas["categoria"]
+        return [(cat, int(dq), float(ts), float(dc))
+                for cat, dq, ts, dc in zip(m["categoria"], m["dias_quiebre"], m["tasa_servicio"], m["dias_cobertura"])]
+
+    def guardar_simulacion(self, gasto_anual, limites, quincenas, productos, poblacion, metricas=None, tope=None):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        sim_id = self._insertar_simulacion(cursor, gasto_anual, limites, quincenas, productos, poblacion, metricas, tope=tope)
         conn.commit()
         conn.close()
+        return sim_id
 
-    def guardar_simulacion(self, gasto_anual, limites, quincenas, productos, poblacion):
+    def guardar_simulaciones_lote(self, resultados, poblaciones, sedes=None, topes=None):
+        """Guarda varias corridas independientes en una sola transacción. Devuelve sus ids."""
         conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
+        ids = []
+        for i, (productos, quincenas, _, limites, gasto_anual, metricas) in enumerate(resultados):
+            ids.append(self._insertar_simulacion(cursor, gasto_anual, limites, quincenas, productos, poblaciones[i], metricas,
+                                                 sede=sedes[i] if sedes else None, tope=topes[i] if topes else None))
+        conn.commit()
+        conn.close()
+        return ids
+
+    def guardar_corrida_multisede(self, sedes, resultados, almacen_compartido=False, presupuesto_compartido=False):
+        """Guarda cada sede como una simulación hija de una corrida padre. Devuelve el id de la corrida."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+
+        total = sum(sum(r[4].values()) for r in resultados)
+        ahora = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute('''
+            INSERT INTO corridas_multisede (fecha, n_sedes, almacen_compartido, presupuesto_compartido, total_gasto)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (ahora, len(sedes), int(almacen_compartido), int(presupuesto_compartido), total))
+        corrida_id = cursor.lastrowid
+
+        topes = topes_quincenales(sedes, almacen_compartido or presupuesto_compartido)
+        for i, (sede, (productos, quincenas, _, limites, gasto_anual, metricas)) in enumerate(zip(sedes, resultados)):
+            self._insertar_simulacion(cursor, gasto_anual, limites, quincenas, productos, sede["poblacion"], metricas,
+                                      corrida_id=corrida_id, sede=sede.get("nombre", f"Sede {i + 1}"), tope=topes[i])
 
+        conn.commit()
+        conn.close()
+        return corrida_id
+
+    def _insertar_simulacion(self, cursor, gasto_anual, limites, quincenas, productos, poblacion, metricas=None,
+                             corrida_id=None, sede=None, tope=None):
+        # tope: límite quincenal contra el que se evalúan las alertas (el de la bolsa si es compartida)
+        tope = LIMITE_QUINCENAL if tope is None else float(tope)
         total = sum(gasto_anual.values())
         ahora = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute("INSERT INTO simulaciones (fecha, poblacion, total_gasto) VALUES (?, ?, ?)", (ahora, poblacion, total))
+        cursor.execute("INSERT INTO simulaciones (fecha, poblacion, total_gasto, corrida_id, sede, limite_quincenal) VALUES (?, ?, ?, ?, ?, ?)",
+                       (ahora, poblacion, total, corrida_id, sede, tope))
         sim_id = cursor.lastrowid
 
         for cat, gasto in gasto_anual.items():
@@ -91,43 +273,256 @@ class GestorBD:
             ''', (sim_id, cat, gasto, limite, estado))
 
         for q, val in quincenas.items():
-            alerta = "OK"
-            if val > 9999.01: alerta = "ERROR CRÍTICO"
-            elif val > 9500: alerta = "AL LÍMITE"
+            alerta = clasificar_quincena(val, tope)
             cursor.execute('''
                 INSERT INTO detalles_quincena (simulacion_id, quincena, gasto, alerta)
                 VALUES (?, ?, ?, ?)
             ''', (sim_id, q, val, alerta))
 
         for p in productos:
-            historia_str = json.dumps(p.historia_stock)
+            historia_blob = np.asarray(p.historia_stock, dtype=np.float32).tobytes()
             cursor.execute('''
-                INSERT INTO detalles_stock (simulacion_id, nombre_producto, historia_json, prioridad, categoria)
+                INSERT INTO detalles_stock (simulacion_id, nombre_producto, historia_blob, prioridad, categoria)
                 VALUES (?, ?, ?, ?, ?)
-            ''', (sim_id, p.nombre, historia_str, p.prioridad, p.categoria))
+            ''', (sim_id, p.nombre, historia_blob, p.prioridad, p.categoria))
+
+        if metricas:
+            mp = metricas["producto"]
+            for i, nombre in enumerate(mp["nombre"]):
+                cursor.execute('''
+                    INSERT INTO metricas_producto (simulacion_id, nombre_producto, categoria, demanda, insatisfecha, dias_quiebre, tasa_servicio, dias_cobertura)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (sim_id, nombre, mp["categoria"][i], float(mp["demanda"][i]), float(mp["insatisfecha"][i]),
+                      int(mp["dias_quiebre"][i]), float(mp["tasa_servicio"][i]), float(mp["dias_cobertura"][i])))
+
+            mc = metricas["categoria"]
+            for i, cat in enumerate(mc["categoria"]):
+                cursor.execute('''
+                    INSERT INTO metricas_categoria (simulacion_id, categoria, demanda, insatisfecha, dias_quiebre, tasa_servicio, dias_cobertura)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (sim_id, cat, float(mc["demanda"][i]), float(mc["insatisfecha"][i]),
+                      int(mc["dias_quiebre"][i]), float(mc["tasa_servicio"][i]), float(mc["dias_cobertura"][i])))
 
-        conn.commit()
-        conn.close()
         return sim_id
 
     # NUEVO METODO PARA ELIMINAR
     def eliminar_simulacion(self, sim_id):
+        """
+        Elimina una simulación en una sola transacción. Si es una sede de una corrida multisede,
+        la corrida padre se recalcula (n_sedes y total_gasto) o se elimina si era la última sede.
+        """
         conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
         try:
+            cursor.execute("SELECT corrida_id FROM simulaciones WHERE id=?", (sim_id,))
+            row = cursor.fetchone()
+            self._eliminar_simulaciones(cursor, [sim_id])
+            if row is not None and row[0] is not None:
+                corrida_id = row[0]
+                cursor.execute("SELECT COUNT(*), COALESCE(SUM(total_gasto), 0) FROM simulaciones WHERE corrida_id=?", (corrida_id,))
+                n_sedes, total = cursor.fetchone()
+                if n_sedes == 0:
+                    self._eliminar_corrida(cursor, corrida_id)
+                else:
+                    cursor.execute("UPDATE corridas_multisede SET n_sedes=?, total_gasto=? WHERE id=?", (n_sedes, total, corrida_id))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            print(f"Error al eliminar: {e}")
+            return False
+        finally:
+            conn.close()
+
+    def eliminar_corrida_multisede(self, corrida_id):
+        """Elimina la corrida padre con todas sus sedes y checkpoints en una sola transacción."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT id FROM simulaciones WHERE corrida_id=?", (corrida_id,))
+            self._eliminar_simulaciones(cursor, [row[0] for row in cursor.fetchall()])
+            self._eliminar_corrida(cursor, corrida_id)
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            print(f"Error al eliminar: {e}")
+            return False
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _eliminar_simulaciones(cursor, ids):
+        for sim_id in ids:
             # Eliminar datos hijos primero
             cursor.execute("DELETE FROM detalles_categoria WHERE simulacion_id=?", (sim_id,))
             cursor.execute("DELETE FROM detalles_quincena WHERE simulacion_id=?", (sim_id,))
             cursor.execute("DELETE FROM detalles_stock WHERE simulacion_id=?", (sim_id,))
+            cursor.execute("DELETE FROM metricas_producto WHERE simulacion_id=?", (sim_id,))
+            cursor.execute("DELETE FROM metricas_categoria WHERE simulacion_id=?", (sim_id,))
+            cursor.execute("DELETE FROM checkpoints WHERE simulacion_id=?", (sim_id,))
             # Eliminar padre
             cursor.execute("DELETE FROM simulaciones WHERE id=?", (sim_id,))
-            conn.commit()
-            return True
-        except Exception as e:
-            print(f"Error al eliminar: {e}")
-            return False
+
+    @staticmethod
+    def _eliminar_corrida(cursor, corrida_id):
+        cursor.execute("DELETE FROM checkpoints WHERE corrida_id=?", (corrida_id,))
+        cursor.execute("DELETE FROM corridas_multisede WHERE id=?", (corrida_id,))
+
+    def obtener_corrida_multisede(self, corrida_id):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, sede, poblacion, total_gasto FROM simulaciones WHERE corrida_id=? ORDER BY id", (corrida_id,))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def guardar_checkpoints(self, sedes, checkpoints, simulacion_id=None, corrida_id=None):
+        """
+        Guarda los checkpoints {dia: estado} tomados por motor.correr(dias_checkpoint=...) junto
+        con las sedes con que se corrió (las que usa por omisión una reanudación). Devuelve sus ids.
+        """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        ahora = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        sedes_str = json.dumps(sedes)
+        ids = []
+        for dia, estado in sorted(checkpoints.items()):
+            cursor.execute('''
+                INSERT INTO checkpoints (fecha, simulacion_id, corrida_id, dia, sedes_json, estado)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (ahora, simulacion_id, corrida_id, dia, sedes_str, sqlite3.Binary(estado)))
+            ids.append(cursor.lastrowid)
+        conn.commit()
+        conn.close()
+        return ids
+
+    def listar_checkpoints(self, simulacion_id=None, corrida_id=None):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, dia, fecha, LENGTH(estado) FROM checkpoints
+            WHERE simulacion_id IS ? AND corrida_id IS ? ORDER BY dia
+        ''', (simulacion_id, corrida_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def obtener_checkpoint(self, checkpoint_id):
+        """Devuelve (dia, sedes, estado) listo para MotorSimulacion.desde_checkpoint."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT dia, sedes_json, estado FROM checkpoints WHERE id=?", (checkpoint_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None: return None
+        return row[0], json.loads(row[1]), bytes(row[2])
+
+    def crear_almacen_resultados(self, ruta, capacidad, n_dias, productos):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        fecha = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute('''
+            INSERT INTO almacenes_resultados (fecha, ruta, capacidad, n_dias, productos_json, n_corridas, reservadas)
+            VALUES (?, ?, ?, ?, ?, 0, 0)
+        ''', (fecha, ruta, capacidad, n_dias, json.dumps(productos)))
+        almacen_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return almacen_id
+
+    def reservar_corridas_almacen(self, almacen_id, cantidad):
+        """Aparta las siguientes `cantidad` filas del almacén antes de escribirlas. Devuelve el inicio."""
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT reservadas, capacidad FROM almacenes_resultados WHERE id=?", (almacen_id,))
+            row = cursor.fetchone()
+            if row is None: raise ValueError(f"No existe el almacén de resultados {almacen_id}")
+            inicio, capacidad = row
+            if inicio + cantidad > capacidad:
+                raise ValueError(f"El almacén admite {capacidad} corridas y ya tiene {inicio} reservadas")
+            cursor.execute("UPDATE almacenes_resultados SET reservadas=? WHERE id=?", (inicio + cantidad, almacen_id))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
         finally:
             conn.close()
+        return inicio
+
+    def liberar_corridas_almacen(self, almacen_id, inicio, cantidad):
+        """Devuelve una reserva no escrita si sigue siendo la última; si no, queda como hueco."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("UPDATE almacenes_resultados SET reservadas=? WHERE id=? AND reservadas=?",
+                       (inicio, almacen_id, inicio + cantidad))
+        liberada = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        return liberada
+
+    def registrar_lote_almacen(self, almacen_id, inicio, cantidad, parametros):
+        """
+        Confirma un lote reservado y ya escrito. n_corridas avanza sobre los lotes confirmados
+        contiguos desde el inicio, así un lote que termina antes que otro reservado previamente no
+        se lee hasta que el anterior también se confirme. Devuelve el nuevo n_corridas.
+        """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        fecha = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute("SELECT n_corridas, reservadas FROM almacenes_resultados WHERE id=?", (almacen_id,))
+        n_corridas, reservadas = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*) FROM lotes_almacen WHERE almacen_id=? AND inicio=?", (almacen_id, inicio))
+        if inicio < n_corridas or inicio + cantidad > reservadas or cursor.fetchone()[0]:
+            conn.close()
+            raise ValueError(f"Las corridas {inicio}-{inicio + cantidad} del almacén {almacen_id} no están reservadas")
+        cursor.execute('''
+            INSERT INTO lotes_almacen (almacen_id, fecha, inicio, cantidad, parametros_json)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (almacen_id, fecha, inicio, cantidad, json.dumps(parametros)))
+        while True:
+            cursor.execute("SELECT cantidad FROM lotes_almacen WHERE almacen_id=? AND inicio=?", (almacen_id, n_corridas))
+            row = cursor.fetchone()
+            if row is None: break
+            n_corridas += row[0]
+        cursor.execute("UPDATE almacenes_resultados SET n_corridas=? WHERE id=?", (n_corridas, almacen_id))
+        conn.commit()
+        conn.close()
+        return n_corridas
+
+    def listar_almacenes_resultados(self):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, fecha, n_corridas, capacidad FROM almacenes_resultados ORDER BY id DESC")
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def obtener_almacen_resultados(self, almacen_id):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, fecha, ruta, capacidad, n_dias, productos_json, n_corridas, reservadas
+            FROM almacenes_resultados WHERE id=?
+        ''', (almacen_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None: return None
+        return {"id": row[0], "fecha": row[1], "ruta": row[2], "capacidad": row[3], "n_dias": row[4],
+                "productos": json.loads(row[5]), "n_corridas": row[6], "reservadas": row[7]}
+
+    def listar_lotes_almacen(self, almacen_id):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT inicio, cantidad, fecha, parametros_json FROM lotes_almacen
+            WHERE almacen_id=? ORDER BY inicio
+        ''', (almacen_id,))
+        rows = [(row[0], row[1], row[2], json.loads(row[3])) for row in cursor.fetchall()]
+        conn.close()
+        return rows
 
     def obtener_resumen_home(self):
         conn = sqlite3.connect(self.db_name)
@@ -148,7 +543,7 @@ class GestorBD:
     def obtener_historial_lista(self):
         conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
-        cursor.execute("SELECT id, fecha, poblacion, total_gasto FROM simulaciones ORDER BY id DESC")
+        cursor.execute("SELECT id, fecha, poblacion, total_gasto, sede FROM simulaciones ORDER BY id DESC")
         rows = cursor.fetchall()
         conn.close()
         return rows
@@ -163,7 +558,7 @@ class GestorBD:
         cursor.execute("SELECT quincena, gasto, alerta FROM detalles_quincena WHERE simulacion_id=?", (sim_id,))
         quins = cursor.fetchall()
 
-        cursor.execute("SELECT nombre_producto, historia_json, prioridad, categoria FROM detalles_stock WHERE simulacion_id=?", (sim_id,))
+        cursor.execute("SELECT nombre_producto, historia_json, prioridad, categoria, historia_blob FROM detalles_stock WHERE simulacion_id=?", (sim_id,))
         stocks_raw = cursor.fetchall()
 
         conn.close()
@@ -182,13 +577,194 @@ class GestorBD:
 
         for row in stocks_raw:
             nombre = row[0]
-            historia = json.loads(row[1])
+            historia = self.decodificar_historia(row[4], row[1]).tolist()
             prioridad = row[2]
-            categoria = row[3] if len(row) > 3 else "OTROS"
+            categoria = row[3] or "OTROS"
             productos_recuperados.append(ProductoDummy(nombre, historia, prioridad, categoria))
 
         return gasto_anual, limites, quincenas, productos_recuperados
 
+    def obtener_limite_quincenal(self, sim_id):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT limite_quincenal FROM simulaciones WHERE id=?", (sim_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return LIMITE_QUINCENAL if row is None or row[0] is None else row[0]
+
+    def obtener_metricas_categoria(self, sim_id):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT categoria, dias_quiebre, tasa_servicio, dias_cobertura FROM metricas_categoria WHERE simulacion_id=? ORDER BY id", (sim_id,))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def obtener_resumen_simulacion(self, sim_id):
+        """Resumen sin historias de stock (para la API): gasto por categoría, quincenas y servicio."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, fecha, poblacion, total_gasto, sede, corrida_id, limite_quincenal FROM simulaciones WHERE id=?", (sim_id,))
+        sim = cursor.fetchone()
+        if sim is None:
+            conn.close()
+            return None
+        cursor.execute("SELECT categoria, gasto, limite, estado FROM detalles_categoria WHERE simulacion_id=?", (sim_id,))
+        cats = cursor.fetchall()
+        cursor.execute("SELECT quincena, gasto, alerta FROM detalles_quincena WHERE simulacion_id=?", (sim_id,))
+        quins = cursor.fetchall()
+        conn.close()
+
+        return {
+            "id": sim[0], "fecha": sim[1], "poblacion": sim[2], "total_gasto": sim[3], "sede": sim[4], "corrida_id": sim[5],
+            "limite_quincenal": LIMITE_QUINCENAL if sim[6] is None else sim[6],
+            "categorias": [{"categoria": c, "gasto": g, "limite": l, "estado": e} for c, g, l, e in cats],
+            "quincenas": [{"quincena": q, "gasto": g, "alerta": a} for q, g, a in quins],
+            "servicio": [{"categoria": c, "dias_quiebre": dq, "tasa_servicio": ts, "dias_cobertura": dc}
+                         for c, dq, ts, dc in self.obtener_metricas_categoria(sim_id)],
+        }
+
+    def iterar_historias_stock(self, sim_id, lote=8):
+        """Recorre las historias de stock por lotes sin cargarlas todas en memoria."""
+        conn = sqlite3.connect(self.db_name)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT nombre_producto, categoria, prioridad, historia_blob, historia_json FROM detalles_stock WHERE simulacion_id=? ORDER BY id", (sim_id,))
+            while True:
+                rows = cursor.fetchmany(lote)
+                if not rows: break
+                for nombre, categoria, prioridad, blob, texto in rows:
+                    yield nombre, categoria, prioridad, self.decodificar_historia(blob, texto)
+        finally:
+            conn.close()
+
+    # --- Agregados para comparar grupos de simulaciones ---
+    def ids_por_poblacion(self, poblacion):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM simulaciones WHERE poblacion=? ORDER BY id", (poblacion,))
+        ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return ids
+
+    def ids_inexistentes(self, ids):
+        """Ids de la lista que no están en simulaciones."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        marcas = ",".join("?" * len(ids))
+        cursor.execute(f"SELECT id FROM simulaciones WHERE id IN ({marcas})", list(ids))
+        existentes = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        return [i for i in ids if i not in existentes]
+
+    def agregados_categoria(self, ids):
+        """(categoria, n, media, media de cuadrados) del gasto anual, agregado en SQL."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        marcas = ",".join("?" * len(ids))
+        cursor.execute(f'''
+            SELECT categoria, COUNT(*), AVG(gasto), AVG(gasto * gasto) FROM detalles_categoria
+            WHERE simulacion_id IN ({marcas}) GROUP BY categoria
+        ''', list(ids))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def excesos_quincena(self, ids, tolerancia=0.0):
+        """
+        (simulacion_id, quincenas, quincenas sobre el tope) por simulación, agregado en SQL. Cada
+        simulación se evalúa contra su propio limite_quincenal (LIMITE_QUINCENAL si es antigua).
+        """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        marcas = ",".join("?" * len(ids))
+        cursor.execute(f'''
+            SELECT q.simulacion_id, COUNT(*), SUM(q.gasto > COALESCE(s.limite_quincenal, ?) + ?)
+            FROM detalles_quincena q JOIN simulaciones s ON s.id = q.simulacion_id
+            WHERE q.simulacion_id IN ({marcas}) GROUP BY q.simulacion_id
+        ''', [LIMITE_QUINCENAL, tolerancia] + list(ids))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def historias_por_producto(self, ids):
+        """Historias de stock de varias simulaciones como {producto: matriz (simulaciones x días)}."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        marcas = ",".join("?" * len(ids))
+        cursor.execute(f'''
+            SELECT nombre_producto, historia_blob, historia_json FROM detalles_stock
+            WHERE simulacion_id IN ({marcas}) ORDER BY nombre_producto, simulacion_id
+        ''', list(ids))
+        historias = {}
+        for nombre, blob, texto in cursor:
+            historias.setdefault(nombre, []).append(self.decodificar_historia(blob, texto))
+        conn.close()
+        return {nombre: np.stack(filas) for nombre, filas in historias.items()}
+
+    # --- Cola persistente de trabajos del servicio HTTP ---
+    def crear_trabajo(self, tipo, clave, parametros):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        ahora = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute('''
+            INSERT INTO trabajos (tipo, clave, parametros_json, estado, creado, actualizado)
+            VALUES (?, ?, ?, 'pendiente', ?, ?)
+        ''', (tipo, clave, json.dumps(parametros), ahora, ahora))
+        trabajo_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return trabajo_id
+
+    def buscar_trabajo_activo(self, clave):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM trabajos WHERE clave=? AND estado IN ('pendiente', 'en_curso') ORDER BY id LIMIT 1", (clave,))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def actualizar_trabajo(self, trabajo_id, estado, resultado=None, error=None):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        ahora = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute("UPDATE trabajos SET estado=?, resultado_json=?, error=?, actualizado=? WHERE id=?",
+                       (estado, json.dumps(resultado) if resultado is not None else None, error, ahora, trabajo_id))
+        conn.commit()
+        conn.close()
+
+    def obtener_trabajo(self, trabajo_id):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, tipo, parametros_json, estado, resultado_json, error, creado, actualizado FROM trabajos WHERE id=?", (trabajo_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None: return None
+        return {"id": row[0], "tipo": row[1], "parametros": json.loads(row[2]), "estado": row[3],
+                "resultado": json.loads(row[4]) if row[4] else None, "error": row[5], "creado": row[6], "actualizado": row[7]}
+
+    def reanudar_trabajos_pendientes(self):
+        """Al arrancar, los trabajos interrumpidos vuelven a la cola. Devuelve (id, tipo, parametros) en orden."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute("UPDATE trabajos SET estado='pendiente' WHERE estado='en_curso'")
+        cursor.execute("SELECT id, tipo, parametros_json FROM trabajos WHERE estado='pendiente' ORDER BY id")
+        rows = [(row[0], row[1], json.loads(row[2])) for row in cursor.fetchall()]
+        conn.commit()
+        conn.close()
+        return rows
+
+    def obtener_metricas_producto(self, sim_id):
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT nombre_producto, categoria, demanda, insatisfecha, dias_quiebre, tasa_servicio, dias_cobertura
+            FROM metricas_producto WHERE simulacion_id=? ORDER BY id
+        ''', (sim_id,))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
 
 # ==============================================================================
 # BLOQUE 1: CONFIGURACIÓN LOGÍSTICA
@@ -205,27 +781,40 @@ DIAS_LIBRES_2025 = [
     (11, 5), (11, 10), (11, 28), (12, 8), (12, 25)
 ]
 
-def obtener_demanda_calendario(dia_anio, poblacion_simulada):
+TASAS_CALENDARIO = {"VERANO": TASA_VERANO, "SEM_I": TASA_SEM_I, "JULIO": TASA_JULIO,
+                     "SEM_II": TASA_SEM_II, "BAJA": TASA_BAJA}
+
+def factor_calendario(dia_anio, dias_libres=None, tasas=None):
+    tasas = {**TASAS_CALENDARIO, **(tasas or {})}
+    dias_libres = DIAS_LIBRES_2025 if dias_libres is None else dias_libres
     fecha_base = datetime.date(2025, 1, 1)
     fecha_actual = fecha_base + datetime.timedelta(days=dia_anio - 1)
     mes, dia, weekday = fecha_actual.month, fecha_actual.day, fecha_actual.weekday()
 
-    if weekday >= 5: return 0
-    if (mes, dia) in DIAS_LIBRES_2025: return 0
+    if weekday >= 5: return 0.0
+    if (mes, dia) in dias_libres: return 0.0
 
-    factor = TASA_BAJA
+    factor = tasas["BAJA"]
     if mes <= 3 and dia < 31:
-        factor = TASA_VERANO
+        factor = tasas["VERANO"]
     elif (mes == 3 and dia >= 31) or (mes > 3 and mes < 7) or (mes == 7 and dia <= 12):
-        factor = TASA_SEM_I
+        factor = tasas["SEM_I"]
     elif mes == 7 and dia > 12:
-        factor = TASA_JULIO
+        factor = tasas["JULIO"]
     elif (mes == 8 and dia >= 18) or (mes > 8 and mes < 11) or (mes == 11 and dia <= 28):
-        factor = TASA_SEM_II
+        factor = tasas["SEM_II"]
+    return factor
+
+LIMITE_QUINCENAL = 9999.00
+QUINCENAS_ANIO = 26
+# Una quincena queda "AL LÍMITE" sobre esta fracción del tope y en "ERROR CRÍTICO" al rebasarlo
+UMBRAL_ALERTA_QUINCENA = 0.95
+TOLERANCIA_TOPE = 0.01
 
-    demanda_base = int(poblacion_simulada * factor)
-    variabilidad = np.random.uniform(0.99, 1.02)
-    return int(demanda_base * variabilidad)
+def clasificar_quincena(gasto, tope=LIMITE_QUINCENAL):
+    if gasto > tope + TOLERANCIA_TOPE: return "ERROR CRÍTICO"
+    if gasto > tope * UMBRAL_ALERTA_QUINCENA: return "AL LÍMITE"
+    return "OK"
 
 CONFIG_ALMACEN = {
     "CARNES":        {"Max_Stock": 600, "Ref_Gasto_3M": 14000},
@@ -243,9 +832,33 @@ CONFIG_ALMACEN = {
     "OTROS/DESECHABLES": {"Max_Stock": 10, "Ref_Gasto_3M": 250}
 }
 
+# Reglas del menú diario. Modos:
+#   "azar":     elige 'cantidad' productos distintos de la categoría cada día (pct por posición)
+#   "rotacion": recorre la categoría en orden, uno por día
+#   "todos":    todos los productos de la categoría; 'pct_rango' sortea un pct diario común
+# 'incluye'/'excluye' filtran por subcadena del nombre; 'reponer_agotado' dispara un
+# pedido de emergencia si el producto del día está en cero.
+REGLAS_MENU = [
+    {"categoria": "POLLO",       "modo": "azar", "cantidad": 1, "pct": 0.75},
+    {"categoria": "CARNES",      "modo": "azar", "cantidad": 1, "pct": 0.75},
+    {"categoria": "GRANOS",      "modo": "rotacion", "pct": 1.0, "reponer_agotado": True},
+    {"categoria": "PASTAS",      "modo": "rotacion", "pct": 0.33, "reponer_agotado": True},
+    {"categoria": "BEBIDAS",     "modo": "azar", "cantidad": 3, "pct": [0.33, 0.33, 0.34]},
+    {"categoria": "ARROZ",       "modo": "todos", "pct": 1.0},
+    {"categoria": "CONDIMENTOS", "modo": "todos", "pct": 1.0, "incluye": ["SAL", "ACEITE", "AZUCAR"]},
+    {"categoria": "CONDIMENTOS", "modo": "azar", "cantidad": 2, "pct": 1.0, "excluye": ["SAL", "ACEITE", "AZUCAR"]},
+    {"categoria": "VEGETALES",   "modo": "azar", "cantidad": 2, "pct": 1.0},
+    {"categoria": "DESAYUNO",    "modo": "todos", "pct_rango": (0.10, 0.15)},
+    {"categoria": "OTROS/DESECHABLES", "modo": "todos", "pct": 1.0},
+    {"categoria": "SNACKS",         "modo": "todos", "pct": 0.20},
+    {"categoria": "ENLATADOS",      "modo": "todos", "pct": 0.20},
+    {"categoria": "ALIMENTOS_SECO", "modo": "todos", "pct": 0.20},
+]
+
 # ==============================================================================
-# BLOQUE 2: CSV
+# BLOQUE 2: CATÁLOGO
 # ==============================================================================
+# Catálogo inicial; solo se escribe a disco si el archivo externo aún no existe
 csv_data = """Nombre,Precio,Categoria,Racion,Prioridad
 POLLO - ALAS,1.76,POLLO,0.40,Critico
 POLLO - PECHUGA,1.45,POLLO,0.25,Critico
@@ -305,222 +918,1480 @@ REPOLLO (LIBRA),1.20,VEGETALES,0.10,Secundario
 TOMATE PERITA (2 LB),1.75,VEGETALES,0.10,Secundario
 SERVILLETAS (5000 Unidades),15.00,OTROS/DESECHABLES,0.0004,Critico
 """
-with open("base_datos_inteligente_v2.csv", "w") as f: f.write(csv_data)
-df_catalogo = pd.read_csv("base_datos_inteligente_v2.csv")
-CATALOGO_MAESTRO = df_catalogo.to_dict('records')
+RUTA_CATALOGO = os.environ.get("CAFETERIA_CATALOGO", "base_datos_inteligente_v2.csv")
+COLUMNAS_CATALOGO = ["Nombre", "Precio", "Categoria", "Racion", "Prioridad"]
+PRIORIDADES_VALIDAS = ["Critico", "Secundario", "Lujo"]
+
+class Catalogo:
+    """
+    Catálogo de productos cargado desde CSV, JSON o una tabla SQLite (.db/.sqlite).
+    Se valida contra CONFIG_ALMACEN y se compila una sola vez a arreglos NumPy; obtener()
+    revisa mtime/hash del archivo y recarga si cambió. Si la nueva versión no es válida
+    se conserva la anterior.
+    """
+    def __init__(self, ruta, tabla="catalogo"):
+        self.ruta = ruta
+        self.tabla = tabla
+        self.version = 0
+        self._mtime = None
+        self._hash = None
+        self._lock = threading.Lock()
+        self.datos = None
+        self.actualizar()
+        if self.datos is None:
+            raise ValueError(f"No se pudo cargar el catálogo desde {ruta}")
+
+    def leer(self):
+        ext = os.path.splitext(self.ruta)[1].lower()
+        if ext == ".json":
+            with open(self.ruta, encoding="utf-8") as f:
+                contenido = json.load(f)
+            if isinstance(contenido, dict): contenido = contenido.get("productos", [])
+            return pd.DataFrame(contenido)
+        if ext in (".db", ".sqlite", ".sqlite3"):
+            conn = sqlite3.connect(self.ruta)
+            try:
+                return pd.read_sql_query(f"SELECT * FROM {self.tabla}", conn)
+            finally:
+                conn.close()
+        return pd.read_csv(self.ruta)
+
+    @staticmethod
+    def validar(df):
+        faltantes = [c for c in COLUMNAS_CATALOGO if c not in df.columns]
+        if faltantes:
+            raise ValueError(f"Columnas faltantes en el catálogo: {faltantes}")
+
+        df = df[COLUMNAS_CATALOGO].copy()
+        df["Nombre"] = df["Nombre"].astype(str).str.strip()
+        df["Categoria"] = df["Categoria"].astype(str).str.strip()
+        df["Prioridad"] = df["Prioridad"].astype(str).str.strip()
+        df["Precio"] = pd.to_numeric(df["Precio"], errors="coerce")
+        df["Racion"] = pd.to_numeric(df["Racion"], errors="coerce")
+
+        errores = []
+        for i, row in df.iterrows():
+            if not row["Nombre"]: errores.append(f"Fila {i}: nombre vacío")
+            if row["Categoria"] not in CONFIG_ALMACEN: errores.append(f"Fila {i}: categoría desconocida '{row['Categoria']}'")
+            if row["Prioridad"] not in PRIORIDADES_VALIDAS: errores.append(f"Fila {i}: prioridad inválida '{row['Prioridad']}'")
+            if not np.isfinite(row["Precio"]) or row["Precio"] <= 0: errores.append(f"Fila {i}: precio inválido")
+            if not np.isfinite(row["Racion"]) or row["Racion"] < 0: errores.append(f"Fila {i}: ración inválida")
+        duplicados = df["Nombre"][df["Nombre"].duplicated()].tolist()
+        if duplicados: errores.append(f"Nombres duplicados: {duplicados}")
+        if df.empty: errores.append("El catálogo está vacío")
+        if errores:
+            raise ValueError("Catálogo inválido:\n" + "\n".join(errores))
+        return df
+
+    @staticmethod
+    def compilar(df):
+        categorias = list(CONFIG_ALMACEN)
+        return {
+            "registros": df.to_dict('records'),
+            "nombre": df["Nombre"].tolist(),
+            "categoria": df["Categoria"].tolist(),
+            "prioridad": df["Prioridad"].tolist(),
+            "precio": df["Precio"].to_numpy(dtype=np.float64),
+            "racion": df["Racion"].to_numpy(dtype=np.float64),
+            "categoria_idx": np.array([categorias.index(c) for c in df["Categoria"]], dtype=np.intp),
+            "max_stock": np.array([CONFIG_ALMACEN[c]["Max_Stock"] for c in df["Categoria"]], dtype=np.float64),
+        }
+
+    def actualizar(self):
+        """Recarga si el archivo cambió. Devuelve True si se cargó una versión nueva."""
+        with self._lock:
+            # El archivo puede faltar un instante (reemplazo o guardado por renombre): se
+            # conserva la versión cargada y se vuelve a intentar en la próxima llamada
+            try:
+                mtime = os.stat(self.ruta).st_mtime_ns
+                if mtime == self._mtime: return False
+                with open(self.ruta, "rb") as f:
+                    huella = hashlib.sha1(f.read()).hexdigest()
+            except OSError as e:
+                print(f"Error al leer catálogo: {e}")
+                return False
+            self._mtime = mtime
+            if huella == self._hash: return False
+            try:
+                datos = self.compilar(self.validar(self.leer()))
+            except Exception as e:
+                print(f"Error al cargar catálogo: {e}")
+                return False
+            self.datos = datos
+            self._hash = huella
+            self.version += 1
+            return True
+
+    def obtener(self):
+        self.actualizar()
+        return self.datos
+
+def sembrar_catalogo(ruta, tabla="catalogo"):
+    """Crea el catálogo por defecto (csv_data) en el formato que Catalogo.leer espera por la extensión."""
+    ext = os.path.splitext(ruta)[1].lower()
+    df = pd.read_csv(io.StringIO(csv_data))
+    try:
+        if ext == ".json":
+            with open(ruta, "w", encoding="utf-8") as f:
+                json.dump(df.to_dict('records'), f, ensure_ascii=False, indent=1)
+        elif ext not in (".db", ".sqlite", ".sqlite3"):
+            with open(ruta, "w") as f: f.write(csv_data)
+        else:
+            conn = sqlite3.connect(ruta)
+            try:
+                df.to_sql(tabla, conn, index=False)
+            finally:
+                conn.close()
+    except Exception:
+        # No dejar un archivo a medias que bloquee el siguiente arranque
+        if os.path.exists(ruta): os.remove(ruta)
+        raise
+
+if not os.path.exists(RUTA_CATALOGO):
+    sembrar_catalogo(RUTA_CATALOGO)
+CATALOGO = Catalogo(RUTA_CATALOGO)
 
 # ==============================================================================
 # BLOQUE 3: MOTOR DE SIMULACIÓN
 # ==============================================================================
+def crear_generadores(semilla, cantidad):
+    # Un flujo independiente por componente (números aleatorios comunes entre corridas)
+    if semilla is None: return [np.random] * cantidad
+    return [np.random.RandomState(np.random.MT19937(s)) for s in np.random.SeedSequence(semilla).spawn(cantidad)]
+
+def ratio_objetivo_base(categoria):
+    return 0.20 if categoria in ["CARNES", "POLLO", "VEGETALES"] else 0.50
+
+ALTA_ROTACION = ["CARNES", "POLLO", "VEGETALES", "GRANOS", "PASTAS", "ARROZ"]
+ENTREGA_RAPIDA = ["CARNES", "POLLO", "VEGETALES", "GRANOS", "PASTAS"]
+ORDEN_COMPRA = ["ARROZ", "GRANOS", "CARNES", "POLLO", "VEGETALES", "PASTAS", "CONDIMENTOS", "ENLATADOS", "DESAYUNO", "ALIMENTOS_SECO", "SNACKS", "BEBIDAS", "OTROS/DESECHABLES"]
+
+# Tipos de pedido codificados para operar sobre arreglos
+SIN_PEDIDO, QUINCENAL, MENSUAL, RELLENO = 0, 1, 2, 3
+ETIQUETA_PEDIDO = {QUINCENAL: "Q", MENSUAL: "M", RELLENO: "R"}
+
 class AlmacenProducto:
-    def __init__(self, item_data):
+    """Vista de un producto en una sede al terminar la corrida (la usan la GUI y GestorBD)."""
+    def __init__(self, item_data, config_almacen=None, ratio_objetivo=None):
         self.nombre = item_data['Nombre']
         self.categoria = item_data['Categoria']
         self.precio = item_data['Precio']
         self.racion_base = item_data['Racion']
         self.prioridad = item_data['Prioridad']
 
-        cfg = CONFIG_ALMACEN.get(self.categoria, CONFIG_ALMACEN.get("OTROS", {}))
+        cfg = (config_almacen or CONFIG_ALMACEN).get(self.categoria, {})
         self.max_stock = cfg.get("Max_Stock", 200)
-        self.target_fill_ratio = 0.20 if self.categoria in ["CARNES", "POLLO", "VEGETALES"] else 0.50
+        self.target_fill_ratio = ratio_objetivo if ratio_objetivo is not None else ratio_objetivo_base(self.categoria)
 
-        self.stock = self.max_stock * np.random.uniform(0.1, 0.4)
+        self.stock = 0.0
         self.pedidos_en_camino = []
         self.historia_stock = []
         self.historia_compras = []
 
-    def recibir_pedidos(self, dia_actual):
-        llegados = [p for p in self.pedidos_en_camino if p[0] <= dia_actual]
-        self.pedidos_en_camino = [p for p in self.pedidos_en_camino if p[0] > dia_actual]
-        for p in llegados:
-            self.stock += p[1]
-
-    def realizar_pedido(self, dia_actual, tipo_pedido, limite_dinero, poblacion_actual):
-        gasto_pedido = 0
-        compra_msg = ""
-        stock_objetivo = self.max_stock * self.target_fill_ratio
-
-        if tipo_pedido == 'RELLENO':
-            stock_objetivo = self.max_stock * 0.40
-
-        en_camino = sum(p[1] for p in self.pedidos_en_camino)
-        if en_camino > stock_objetivo * 0.8: return 0, ""
+def cantidad_pedido(deficit, precio, limite, es_relleno):
+    # Misma regla que el pedido individual: recorta al dinero disponible y en RELLENO
+    # pide un 10% extra si alcanza
+    cant = np.where(deficit * precio > limite, limite // precio, deficit)
+    extra = es_relleno & (cant * 1.1 * precio <= limite)
+    cant = np.where(extra, np.floor(cant * 1.1), cant)
+    return np.where((deficit > 0) & (cant >= 1), cant, 0.0)
+
+# Políticas de asignación del presupuesto quincenal (ver LibroPresupuesto)
+POLITICAS_PRESUPUESTO = ("prioridad", "proporcional", "criticos")
+# Con la política "criticos" una bolsa está estrecha si le queda menos de esta fracción del tope
+FRACCION_ESTRECHA = 0.25
+
+class LibroPresupuesto:
+    """
+    Libro del presupuesto de compras: límites anuales por categoría y tope quincenal de cada
+    bolsa, gasto por fila (categoría y quincena) y un registro de cada débito. Concentra las
+    reglas del calendario de compras (cambio de quincena cada 14 días, días de pedido quincenal
+    y mensual) y asigna de una sola pasada los pedidos de un día según la política:
+
+    - prioridad: en el orden de ORDEN_COMPRA cada pedido se cubre completo mientras alcancen el
+      límite de su categoría y el tope; el que desborda recibe lo que queda y los siguientes
+      nada (las sedes de una bolsa común se atienden en orden de sede).
+    - proporcional: si los pedidos rebasan lo disponible de una categoría (y luego de la
+      bolsa), todos se recortan en la misma proporción.
+    - criticos: como prioridad, pero con la bolsa estrecha (menos de FRACCION_ESTRECHA del
+      tope o pedidos que no caben) solo se surten los productos críticos.
+    """
+    DTYPE_MOVIMIENTO = np.dtype([("dia", np.int32), ("quincena", np.int16), ("fila", np.int32),
+                                 ("bolsa", np.int32), ("producto", np.int32), ("categoria", np.int16),
+                                 ("tipo", np.int8), ("emergencia", np.bool_), ("monto", np.float64)])
+    # Arreglos que forman el estado del libro (se guardan en los checkpoints del motor)
+    CAMPOS_ESTADO = ["presupuesto", "gasto_cat", "gasto_fila_cat", "quincenas_fila"]
+
+    def __init__(self, limites, tope, bolsa_fila, cat_idx, precio, orden, critico, politica="prioridad"):
+        if politica not in POLITICAS_PRESUPUESTO:
+            raise ValueError(f"Política de presupuesto desconocida: {politica}")
+        self.politica = politica
+        self.limites, self.tope = limites, tope
+        self.bolsa_fila, self.cat_idx, self.precio, self.critico = bolsa_fila, cat_idx, precio, critico
+        self.orden = np.asarray(orden, dtype=np.intp)
+        # Hay una sola bolsa para varias filas (presupuesto o almacén compartido)
+        self.compartida = len(tope) < len(bolsa_fila)
+        # En el orden de compra los productos de una categoría son contiguos: inicio de cada bloque
+        cat_orden = cat_idx[self.orden]
+        nuevo = np.r_[True, cat_orden[1:] != cat_orden[:-1]]
+        self.inicio_bloque = np.maximum.accumulate(np.where(nuevo, np.arange(len(self.orden)), 0))
+
+        self.dia, self.quincena = 0, 1
+        self.presupuesto = tope.copy()
+        self.gasto_cat = np.zeros(limites.shape)
+        self.gasto_fila_cat = np.zeros((len(bolsa_fila), limites.shape[1]))
+        self.quincenas_fila = np.zeros((len(bolsa_fila), QUINCENAS_ANIO))
+        self.lotes = []
+
+    @staticmethod
+    def quincena_de(dia):
+        return min(QUINCENAS_ANIO, (dia // 14) + 1)
+
+    @staticmethod
+    def dias_de_pedido(dia):
+        """(es_dia_quincenal, es_dia_mensual) del calendario de compras."""
+        return dia % 15 == 1, dia % 30 == 1
+
+    def abrir_dia(self, dia):
+        """Pasa al día dado; al empezar una quincena nueva el presupuesto vuelve al tope."""
+        self.dia = dia
+        nueva_quincena = self.quincena_de(dia)
+        if nueva_quincena > self.quincena:
+            self.quincena = nueva_quincena
+            self.presupuesto[:] = self.tope
+
+    def _previo(self, costo):
+        # Costo acumulado antes de cada pedido de la bolsa, recorriendo (producto, fila)
+        if self.compartida:
+            return np.cumsum(costo.ravel()).reshape(costo.shape) - costo
+        return np.cumsum(costo, axis=0) - costo
+
+    def asignar(self, deficit, tipo):
+        """Cantidades (filas x productos) que el presupuesto permite pedir para los déficits del día."""
+        o, bolsas = self.orden, self.bolsa_fila[None, :]
+        d = deficit[:, o].T
+        precio, cats = self.precio[o][:, None], self.cat_idx[o][:, None]
+        relleno = tipo[:, o].T == RELLENO
+        holgura = d * precio * 1.1 + precio
+        deseado = cantidad_pedido(d, precio, holgura, relleno) * precio
+        disp_cat = np.maximum(self.limites - self.gasto_cat, 0)
+        disp = np.maximum(self.presupuesto, 0)
+
+        if self.politica == "criticos":
+            pedido = np.bincount(self.bolsa_fila, deseado.sum(axis=0), len(self.tope))
+            estrecha = (self.presupuesto < self.tope * FRACCION_ESTRECHA) | (pedido > disp)
+            fuera = estrecha[bolsas] & ~self.critico[o][:, None]
+            d, deseado = np.where(fuera, 0.0, d), np.where(fuera, 0.0, deseado)
+
+        if self.politica == "proporcional":
+            pedido_cat = np.zeros_like(disp_cat)
+            np.add.at(pedido_cat, (np.broadcast_to(bolsas, d.shape), np.broadcast_to(cats, d.shape)), deseado)
+            factor_cat = np.minimum(1, np.divide(disp_cat, pedido_cat, out=np.ones_like(disp_cat), where=pedido_cat > 0))
+            costo = deseado * factor_cat[bolsas, cats]
+            pedido = np.bincount(self.bolsa_fila, costo.sum(axis=0), len(self.tope))
+            factor = np.minimum(1, np.divide(disp, pedido, out=np.ones_like(disp), where=pedido > 0))
+            recorte = factor_cat[bolsas, cats] * factor[bolsas]
+            limite = np.where(recorte < 1, costo * factor[bolsas], holgura)
+        else:
+            previo = self._previo(deseado)
+            inicio = previo[self.inicio_bloque]
+            if self.compartida: inicio = inicio[:, :1]
+            limite_cat = np.maximum(disp_cat[bolsas, cats] - (previo - inicio), 0)
+            costo = cantidad_pedido(d, precio, limite_cat, relleno) * precio
+            limite = np.minimum(limite_cat, np.maximum(disp[bolsas] - self._previo(costo), 0))
+
+        cant = np.empty_like(deficit)
+        cant[:, o] = cantidad_pedido(d, precio, limite, relleno).T
+        return cant
+
+    def debitar(self, filas, productos, montos, tipos, emergencia=False):
+        """Carga los montos a la bolsa, la categoría y la quincena de cada fila y los registra."""
+        bolsas, cats = self.bolsa_fila[filas], self.cat_idx[productos]
+        np.add.at(self.presupuesto, bolsas, -montos)
+        np.add.at(self.gasto_cat, (bolsas, cats), montos)
+        np.add.at(self.gasto_fila_cat, (filas, cats), montos)
+        np.add.at(self.quincenas_fila[:, self.quincena - 1], filas, montos)
+
+        lote = np.empty(len(montos), dtype=self.DTYPE_MOVIMIENTO)
+        lote["dia"], lote["quincena"], lote["fila"], lote["bolsa"] = self.dia, self.quincena, filas, bolsas
+        lote["producto"], lote["categoria"], lote["tipo"] = productos, cats, tipos
+        lote["emergencia"], lote["monto"] = emergencia, montos
+        self.lotes.append(lote)
+
+    def movimientos(self):
+        """Todos los débitos registrados, en orden, como arreglo estructurado."""
+        if len(self.lotes) > 1: self.lotes = [np.concatenate(self.lotes)]
+        return self.lotes[0] if self.lotes else np.empty(0, dtype=self.DTYPE_MOVIMIENTO)
+
+    def conciliar(self, tolerancia=1e-6):
+        """Verifica que los acumulados coincidan con la suma de los débitos registrados."""
+        mov = self.movimientos()
+        gasto_cat = np.zeros_like(self.gasto_cat)
+        gasto_fila_cat = np.zeros_like(self.gasto_fila_cat)
+        quincenas_fila = np.zeros_like(self.quincenas_fila)
+        np.add.at(gasto_cat, (mov["bolsa"], mov["categoria"]), mov["monto"])
+        np.add.at(gasto_fila_cat, (mov["fila"], mov["categoria"]), mov["monto"])
+        np.add.at(quincenas_fila, (mov["fila"], mov["quincena"] - 1), mov["monto"])
+        return (np.allclose(gasto_cat, self.gasto_cat, atol=tolerancia)
+                and np.allclose(gasto_fila_cat, self.gasto_fila_cat, atol=tolerancia)
+                and np.allclose(quincenas_fila, self.quincenas_fila, atol=tolerancia))
+
+MODOS_MENU = ("azar", "rotacion", "todos")
+
+def es_numero(valor):
+    """True si el valor es un número finito (los booleanos no cuentan)."""
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool) and np.isfinite(valor)
+
+def validar_reglas_menu(reglas):
+    """Revisa la estructura y los tipos de unas reglas de menú (ver REGLAS_MENU); lanza ValueError si no son válidas."""
+    if not isinstance(reglas, list) or not reglas:
+        raise ValueError("Las reglas de menú deben ser una lista no vacía")
+    for i, regla in enumerate(reglas):
+        if not isinstance(regla, dict): raise ValueError(f"Regla de menú {i}: debe ser un objeto")
+        if regla.get("categoria") not in CONFIG_ALMACEN:
+            raise ValueError(f"Regla de menú {i}: categoría desconocida {regla.get('categoria')}")
+        if regla.get("modo") not in MODOS_MENU:
+            raise ValueError(f"Regla de menú {i}: modo inválido {regla.get('modo')}")
+        if "pct" not in regla and not (regla["modo"] == "todos" and "pct_rango" in regla):
+            raise ValueError(f"Regla de menú {i}: falta pct")
+        cantidad = regla.get("cantidad", 1)
+        if not isinstance(cantidad, int) or isinstance(cantidad, bool) or cantidad < 1:
+            raise ValueError(f"Regla de menú {i}: cantidad debe ser un entero mayor a 0")
+        if "pct" in regla:
+            pct = regla["pct"] if isinstance(regla["pct"], list) else [regla["pct"]]
+            if not all(es_numero(p) and p >= 0 for p in pct):
+                raise ValueError(f"Regla de menú {i}: pct debe ser un número no negativo o una lista de ellos")
+            if isinstance(regla["pct"], list) and (regla["modo"] != "azar" or len(pct) != cantidad):
+                raise ValueError(f"Regla de menú {i}: pct en lista solo aplica al modo azar, con un valor por elemento de cantidad")
+        if "pct_rango" in regla:
+            rango = regla["pct_rango"]
+            if (not isinstance(rango, (list, tuple)) or len(rango) != 2 or not all(es_numero(p) for p in rango)
+                    or not 0 <= rango[0] <= rango[1]):
+                raise ValueError(f"Regla de menú {i}: pct_rango debe ser [mínimo, máximo] con 0 <= mínimo <= máximo")
+        for clave in ("incluye", "excluye"):
+            if clave in regla and not (isinstance(regla[clave], list) and all(isinstance(x, str) for x in regla[clave])):
+                raise ValueError(f"Regla de menú {i}: {clave} debe ser una lista de textos")
+    return reglas
+
+class GeneradorMenu:
+    """
+    Compila unas reglas de menú (por omisión REGLAS_MENU) a tablas de índices enteros sobre el
+    catálogo. preparar() sortea de una vez las elecciones de todo el año para n_series menús
+    independientes; llenar() escribe el pct de demanda de un día en un arreglo reutilizable de
+    forma (n_series, n_productos), el propio del generador si no se le pasa otro.
+    """
+    def __init__(self, nombres, categorias, reglas=REGLAS_MENU):
+        self.n_productos = len(nombres)
+        self.pct_demanda = None
+        self.reglas = []
+        for regla in reglas:
+            idx = [i for i, (nom, cat) in enumerate(zip(nombres, categorias))
+                   if cat == regla["categoria"]
+                   and (not regla.get("incluye") or any(x in nom for x in regla["incluye"]))
+                   and not any(x in nom for x in regla.get("excluye", []))]
+            cantidad = regla.get("cantidad", 1)
+            if not idx or (regla["modo"] == "azar" and len(idx) < cantidad): continue
+            self.reglas.append((regla, np.array(idx, dtype=np.intp)))
+
+    def preparar(self, rng, n_dias, n_series=1):
+        forma = (n_series, n_dias)
+        columnas, pcts, reposicion = [], [], []
+        for regla, idx in self.reglas:
+            if regla["modo"] == "azar":
+                cantidad = regla.get("cantidad", 1)
+                # Muestreo sin reemplazo para todos los días a la vez
+                elegidos = idx[rng.random_sample(forma + (len(idx),)).argsort(axis=-1)[..., :cantidad]]
+                pct = np.broadcast_to(np.asarray(regla["pct"], dtype=float), forma + (cantidad,))
+            elif regla["modo"] == "rotacion":
+                elegidos = np.broadcast_to(idx[np.arange(n_dias) % len(idx)][None, :, None], forma + (1,))
+                pct = np.full(forma + (1,), regla["pct"])
+            else:
+                elegidos = np.broadcast_to(idx, forma + (len(idx),))
+                if "pct_rango" in regla:
+                    pct = np.repeat(rng.uniform(*regla["pct_rango"], size=forma)[..., None], len(idx), axis=-1)
+                else:
+                    pct = np.full(forma + (len(idx),), regla["pct"])
+            columnas.append(elegidos)
+            pcts.append(pct)
+            if regla.get("reponer_agotado"): reposicion.append(elegidos)
+
+        self.indices = np.concatenate(columnas, axis=-1) if columnas else np.zeros(forma + (0,), dtype=np.intp)
+        self.pcts = np.concatenate(pcts, axis=-1) if pcts else np.zeros(forma + (0,))
+        self.reposicion = np.concatenate(reposicion, axis=-1) if reposicion else np.zeros(forma + (0,), dtype=np.intp)
+
+    def llenar(self, dia, pct_demanda=None):
+        if pct_demanda is None:
+            if self.pct_demanda is None:
+                self.pct_demanda = np.zeros((self.indices.shape[0], self.n_productos))
+            pct_demanda = self.pct_demanda
+        pct_demanda.fill(0.0)
+        np.put_along_axis(pct_demanda, self.indices[:, dia], self.pcts[:, dia], axis=1)
+        return pct_demanda
+
+def resumir_metricas(nombres, categorias_producto, categorias, demanda, insatisfecha,
+                     dias_quiebre, dias_quiebre_cat, cobertura_media):
+    """
+    Indicadores de servicio de una sede por producto y por categoría a partir de los
+    acumulados del motor. dias_quiebre_cat cuenta los días en que algún producto de la
+    categoría quedó sin cubrir su demanda.
+    """
+    def tasa(dem, ins):
+        return np.divide(dem - ins, dem, out=np.ones_like(dem), where=dem > 0)
+
+    cat_idx = np.array([categorias.index(c) for c in categorias_producto])
+    conteo = np.bincount(cat_idx, minlength=len(categorias))
+    presentes = conteo > 0
+    dem_cat = np.bincount(cat_idx, weights=demanda, minlength=len(categorias))[presentes]
+    ins_cat = np.bincount(cat_idx, weights=insatisfecha, minlength=len(categorias))[presentes]
+    cob_cat = np.bincount(cat_idx, weights=cobertura_media, minlength=len(categorias))[presentes] / conteo[presentes]
+
+    return {
+        "producto": {
+            "nombre": list(nombres), "categoria": list(categorias_producto),
+            "demanda": demanda, "insatisfecha": insatisfecha,
+            "dias_quiebre": dias_quiebre,
+            "tasa_servicio": tasa(demanda, insatisfecha),
+            "dias_cobertura": cobertura_media,
+        },
+        "categoria": {
+            "categoria": [c for c, ok in zip(categorias, presentes) if ok],
+            "demanda": dem_cat, "insatisfecha": ins_cat,
+            "dias_quiebre": np.asarray(dias_quiebre_cat)[presentes],
+            "tasa_servicio": tasa(dem_cat, ins_cat),
+            "dias_cobertura": cob_cat,
+        },
+    }
+
+def validar_montos(valores, claves, campo, nombre, maximo=None):
+    """Revisa un diccionario {clave: número >= 0} y lo devuelve con valores float; lanza ValueError si no es válido."""
+    if valores is None: return {}
+    if not isinstance(valores, dict):
+        raise ValueError(f"{campo} de la sede {nombre} debe ser un objeto")
+    for clave, valor in valores.items():
+        if clave not in claves:
+            raise ValueError(f"Clave desconocida en {campo} de la sede {nombre}: {clave}")
+        if not es_numero(valor) or valor < 0 or (maximo is not None and valor > maximo):
+            rango = f"entre 0 y {maximo}" if maximo is not None else "mayor o igual a 0"
+            raise ValueError(f"{campo}[{clave}] de la sede {nombre} debe ser un número {rango}")
+    return {clave: float(valor) for clave, valor in valores.items()}
+
+def normalizar_sede(sede):
+    """
+    Completa la configuración de una sede. Claves: nombre, poblacion y opcionalmente
+    dias_libres, tasas (ver TASAS_CALENDARIO), config_almacen (sobrescribe CONFIG_ALMACEN por
+    categoría), limites_anuales, ratios_objetivo, limite_quincenal y reglas_menu (None usa las
+    del motor).
+    """
+    nombre = sede.get("nombre", "Principal")
+    poblacion = sede.get("poblacion")
+    if not isinstance(poblacion, (int, float, str)) or isinstance(poblacion, bool):
+        raise ValueError(f"La población de la sede {nombre} debe ser un número")
+    poblacion = int(poblacion)
+    if poblacion <= 0:
+        raise ValueError(f"La población de la sede {nombre} debe ser mayor a 0")
+    config = {cat: dict(conf) for cat, conf in CONFIG_ALMACEN.items()}
+    config_sede = sede.get("config_almacen") or {}
+    if not isinstance(config_sede, dict):
+        raise ValueError(f"config_almacen de la sede {nombre} debe ser un objeto")
+    for cat, conf in config_sede.items():
+        if cat not in config:
+            raise ValueError(f"Categoría desconocida en la sede {nombre}: {cat}")
+        config[cat].update(validar_montos(conf, ("Max_Stock", "Ref_Gasto_3M"), f"config_almacen[{cat}]", nombre))
+    limites = {cat: conf["Ref_Gasto_3M"] * 4 for cat, conf in config.items()}
+    limites.update(validar_montos(sede.get("limites_anuales"), config, "limites_anuales", nombre))
+    dias_libres = sede.get("dias_libres")
+    if dias_libres is not None:
+        if not isinstance(dias_libres, list) or not all(
+                isinstance(d, (list, tuple)) and len(d) == 2 and all(isinstance(x, int) and not isinstance(x, bool) for x in d)
+                and 1 <= d[0] <= 12 and 1 <= d[1] <= 31 for d in dias_libres):
+            raise ValueError(f"dias_libres de la sede {nombre} debe ser una lista de pares [mes, día]")
+        dias_libres = [tuple(d) for d in dias_libres]
+    limite_quincenal = sede.get("limite_quincenal", LIMITE_QUINCENAL)
+    if not es_numero(limite_quincenal) or limite_quincenal <= 0:
+        raise ValueError(f"limite_quincenal de la sede {nombre} debe ser un número mayor a 0")
+    return {
+        "nombre": nombre,
+        "poblacion": poblacion,
+        "dias_libres": dias_libres,
+        "tasas": validar_montos(sede.get("tasas"), TASAS_CALENDARIO, "tasas", nombre) or None,
+        "config_almacen": config,
+        "limites_anuales": limites,
+        "ratios_objetivo": validar_montos(sede.get("ratios_objetivo"), config, "ratios_objetivo", nombre, maximo=1),
+        "limite_quincenal": float(limite_quincenal),
+        "reglas_menu": None if sede.get("reglas_menu") is None else validar_reglas_menu(sede["reglas_menu"]),
+    }
+
+def topes_quincenales(sedes, compartido=False):
+    """Tope quincenal de cada sede; con almacén o presupuesto compartido es el de la bolsa común."""
+    topes = [normalizar_sede(s)["limite_quincenal"] for s in sedes]
+    return [sum(topes)] * len(topes) if compartido else topes
+
+class MotorSimulacion:
+    """
+    Motor vectorizado: todo el estado vive en arreglos (filas x productos) y todas las sedes
+    avanzan juntas en un mismo ciclo diario.
+
+    - almacen_compartido: una sola fila de inventario abastece a todas las sedes; su Max_Stock,
+      población de referencia y presupuestos son la suma de los de las sedes y los ratios de
+      reorden son los de la primera sede.
+    - presupuesto_compartido: cada sede mantiene su inventario pero los límites anuales y el
+      tope quincenal forman una bolsa común (suma de las sedes), asignada en orden de sede.
+    - politica: cómo reparte el LibroPresupuesto el dinero entre los pedidos del día.
+    - historia: arreglo (filas, n_dias, productos) donde escribir el stock de cada día, por
+      ejemplo una vista de AlmacenResultados; por omisión se crea en memoria.
+    - reglas_menu: reglas para las sedes que no traen las suyas (por omisión REGLAS_MENU); las
+      sedes con las mismas reglas comparten un GeneradorMenu.
+    """
+    # Arreglos que forman el estado dinámico (se guardan en los checkpoints junto a los del libro)
+    CAMPOS_ESTADO = ["stock", "llegadas", "en_camino", "variabilidad", "demanda_unidades", "insatisfecha", "dias_quiebre", "dias_quiebre_cat",
+                     "cobertura_acum", "valor_servido"]
+
+    def __init__(self, sedes, semilla=None, almacen_compartido=False, presupuesto_compartido=False, n_dias=365,
+                 politica="prioridad", historia=None, reglas_menu=None):
+        self.semilla = semilla
+        self.presupuesto_compartido = presupuesto_compartido
+        self.catalogo = cat = CATALOGO.obtener()
+        self.sedes = [normalizar_sede(s) for s in sedes]
+        self.categorias = list(CONFIG_ALMACEN)
+        self.n_dias = n_dias
+        self.almacen_compartido = almacen_compartido
+        n_sedes, n_prod = len(self.sedes), len(cat["nombre"])
+        self.n_filas = 1 if almacen_compartido else n_sedes
+        self.n_bolsas = 1 if (almacen_compartido or presupuesto_compartido) else n_sedes
+        self.fila_sede = np.zeros(n_sedes, dtype=np.intp) if almacen_compartido else np.arange(n_sedes)
+        self.bolsa_fila = np.zeros(self.n_filas, dtype=np.intp) if self.n_bolsas == 1 else np.arange(self.n_filas)
+
+        self.precio = cat["precio"]
+        self.racion = cat["racion"]
+        self.cat_idx = cat["categoria_idx"]
+        self.alta_rotacion = np.array([c in ALTA_ROTACION for c in cat["categoria"]])
+        self.entrega_rapida = np.array([c in ENTREGA_RAPIDA for c in cat["categoria"]])
+        self.critico = np.array([p == 'Critico' for p in cat["prioridad"]])
+        self.orden = sorted(range(n_prod), key=lambda j: (ORDEN_COMPRA.index(cat["categoria"][j]) if cat["categoria"][j] in ORDEN_COMPRA else 99, self.cat_idx[j]))
+        self.una_caliente = (self.cat_idx[:, None] == np.arange(len(self.categorias))[None, :]).astype(float)
+
+        poblacion = np.array([s["poblacion"] for s in self.sedes], dtype=float)
+        max_stock = np.array([[s["config_almacen"][c]["Max_Stock"] for c in cat["categoria"]] for s in self.sedes], dtype=float)
+        ratio = np.array([[s["ratios_objetivo"].get(c, ratio_objetivo_base(c)) for c in cat["categoria"]] for s in self.sedes])
+        self.limites_sede = np.array([[s["limites_anuales"].get(c, 0) for c in self.categorias] for s in self.sedes], dtype=float)
+        tope = np.array([s["limite_quincenal"] for s in self.sedes], dtype=float)
+
+        if almacen_compartido:
+            poblacion_fila, self.max_stock, self.ratio = poblacion.sum(keepdims=True), max_stock.sum(axis=0, keepdims=True), ratio[:1]
+        else:
+            poblacion_fila, self.max_stock, self.ratio = poblacion, max_stock, ratio
+        if self.n_bolsas == 1:
+            limites, tope = self.limites_sede.sum(axis=0, keepdims=True), tope.sum(keepdims=True)
+        else:
+            limites = self.limites_sede
+        self.libro = LibroPresupuesto(limites, tope, self.bolsa_fila, self.cat_idx, self.precio, self.orden,
+                                      self.critico, politica)
+        self.demanda_ref = poblacion_fila[:, None] * 0.20 * self.racion[None, :]
+        self.demanda_ref[self.demanda_ref <= 0] = 0.1
+
+        self.rng_dia, *self.rngs_prod = crear_generadores(semilla, n_prod + 1)
+
+        # --- Estado dinámico ---
+        self.dia = 0
+        self.stock = np.column_stack([self.max_stock[:, j] * rng.uniform(0.1, 0.4, size=self.n_filas)
+                                      for j, rng in enumerate(self.rngs_prod)])
+        self.llegadas = np.zeros((self.n_filas, n_prod, n_dias + 31))
+        self.en_camino = np.zeros((self.n_filas, n_prod))
+        self.logs = [[] for _ in range(self.n_filas)]
+
+        # --- Demanda y menú sorteados para todo el año ---
+        if reglas_menu is not None: validar_reglas_menu(reglas_menu)
+        grupos = {}
+        for s, sede in enumerate(self.sedes):
+            reglas = sede["reglas_menu"] or reglas_menu or REGLAS_MENU
+            grupos.setdefault(json.dumps(reglas, sort_keys=True), (reglas, []))[1].append(s)
+        self.menus = []
+        for reglas, sedes_menu in grupos.values():
+            menu = GeneradorMenu(cat["nombre"], cat["categoria"], reglas)
+            menu.preparar(self.rng_dia, n_dias, len(sedes_menu))
+            self.menus.append((np.array(sedes_menu, dtype=np.intp), reglas, menu))
+        self.variabilidad = self.rng_dia.uniform(0.99, 1.02, size=(n_sedes, n_dias))
+        self.demanda = self._calcular_demanda()
+        self.pct = np.zeros((n_sedes, n_prod))
+
+        # --- Acumuladores de servicio por sede ---
+        self.demanda_unidades = np.zeros((n_sedes, n_prod))
+        self.insatisfecha = np.zeros((n_sedes, n_prod))
+        self.dias_quiebre = np.zeros((n_sedes, n_prod), dtype=np.int64)
+        self.dias_quiebre_cat = np.zeros((n_sedes, len(self.categorias)), dtype=np.int64)
+        self.cobertura_acum = np.zeros((n_sedes, n_prod))
+        self.valor_servido = np.zeros(n_sedes)
+        if historia is None:
+            historia = np.empty((self.n_filas, n_dias, n_prod))
+        elif historia.shape != (self.n_filas, n_dias, n_prod):
+            raise ValueError(f"La historia debe tener forma {(self.n_filas, n_dias, n_prod)}, no {historia.shape}")
+        self.historia = historia
+
+    def _calcular_demanda(self):
+        factores = np.array([[factor_calendario(d, s["dias_libres"], s["tasas"]) for d in range(1, self.n_dias + 1)]
+                             for s in self.sedes])
+        poblacion = np.array([s["poblacion"] for s in self.sedes], dtype=float)
+        return np.floor(np.floor(poblacion[:, None] * factores) * self.variabilidad)
+
+    def _deficit(self, tipo):
+        """Unidades faltantes para llegar al stock objetivo (0 si no corresponde pedir)."""
+        objetivo = self.max_stock * np.where(tipo == RELLENO, 0.40, self.ratio)
+        activo = (tipo != SIN_PEDIDO) & ~(self.en_camino > objetivo * 0.8)
+        return np.where(activo, objetivo - (self.stock + self.en_camino), 0.0)
+
+    def _despachar(self, cant, tipo, sufijo=""):
+        """Coloca los pedidos (filas x productos) con al menos una unidad y los debita en el libro."""
+        pide = cant >= 1
+        if not pide.any(): return
+        filas, productos = np.nonzero(pide)
+        self.libro.debitar(filas, productos, cant[filas, productos] * self.precio[productos], tipo[filas, productos],
+                           emergencia=bool(sufijo))
+
+        for j in self.orden:
+            if not pide[:, j].any(): continue
+            if self.entrega_rapida[j]:
+                demora = self.rngs_prod[j].randint(2, 7, size=self.n_filas)
+            else:
+                mensual = tipo[:, j] == MENSUAL
+                demora = self.rngs_prod[j].randint(np.where(mensual, 15, 7), np.where(mensual, 30, 15))
+
+            filas = np.nonzero(pide[:, j])[0]
+            costo = cant[filas, j] * self.precio[j]
+            llegada = self.dia + demora[filas]
+            self.llegadas[filas, j, llegada] += cant[filas, j]
+            self.en_camino[filas, j] += cant[filas, j]
+
+            nombre = self.catalogo["nombre"][j]
+            for f, g, dia_llegada, t in zip(filas, costo, llegada, tipo[filas, j]):
+                if g > 50 or self.critico[j] or sufijo:
+                    self.logs[f].append(f"[Día {self.dia}] PEDIDO({ETIQUETA_PEDIDO[t]}): {nombre:<20} | LLEGA: Día {dia_llegada} | ${g:,.2f}{sufijo}")
+
+    def avanzar_dia(self):
+        self.dia += 1
+        d = self.dia
+        self.libro.abrir_dia(d)
+
+        llegan = self.llegadas[:, :, d]
+        self.stock += llegan
+        self.en_camino -= llegan
+
+        # Pedidos programados: tipo y déficit de todos los productos a la vez; el libro reparte
+        # el dinero entre todos en una sola pasada
+        es_dia_quincenal, es_dia_mensual = self.libro.dias_de_pedido(d)
+        cobertura = self.stock / self.demanda_ref
+        tipo = np.where(self.alta_rotacion,
+                        np.where(es_dia_quincenal | (cobertura < 5), QUINCENAL, SIN_PEDIDO),
+                        MENSUAL if es_dia_mensual else np.where(cobertura < 10, RELLENO, SIN_PEDIDO))
+        deficit = self._deficit(tipo)
+        if (deficit > 0).any(): self._despachar(self.libro.asignar(deficit, tipo), tipo)
+
+        # Reposición de emergencia de los productos rotativos del día que están en cero
+        # (fuera de la asignación: hasta $500 por pedido, pero se debita del libro igual)
+        if len(self.menus) == 1:
+            self.menus[0][2].llenar(d - 1, self.pct)
+        else:
+            for sedes_menu, _, menu in self.menus:
+                self.pct[sedes_menu] = menu.llenar(d - 1)
+        for sedes_menu, _, menu in self.menus:
+            filas = self.fila_sede[sedes_menu]
+            for k in range(menu.reposicion.shape[-1]):
+                prods = menu.reposicion[:, d - 1, k]
+                agotado = self.stock[filas, prods] <= 0
+                if not agotado.any(): continue
+                tipo = np.full(self.stock.shape, SIN_PEDIDO)
+                tipo[filas[agotado], prods[agotado]] = RELLENO
+                cant = cantidad_pedido(self._deficit(tipo), self.precio, 500.0, tipo == RELLENO)
+                self._despachar(cant, tipo, sufijo=" (AGOTADO)")
+
+        # Consumo
+        ruido = self.rng_dia.normal(1, 0.05, size=self.pct.shape)
+        teorico = self.demanda[:, d - 1, None] * self.pct * self.racion * ruido
+        if self.almacen_compartido:
+            total = teorico.sum(axis=0)
+            servido = np.minimum(total, self.stock[0])
+            real = teorico * np.divide(servido, total, out=np.ones_like(total), where=total > 0)
+            self.stock[0] -= servido
+        else:
+            real = np.minimum(teorico, self.stock)
+            self.stock -= real
+
+        quiebre = teorico > real
+        self.demanda_unidades += teorico
+        self.insatisfecha += teorico - real
+        self.dias_quiebre += quiebre
+        self.dias_quiebre_cat += (quiebre @ self.una_caliente) > 0
+        self.cobertura_acum += self.stock[self.fila_sede] / self.demanda_ref[self.fila_sede]
+        self.valor_servido += real @ self.precio
+        self.historia[:, d - 1] = self.stock
+
+    def correr(self, dias_checkpoint=None):
+        """Avanza hasta n_dias; al cerrar cada día de dias_checkpoint guarda el estado en self.checkpoints."""
+        dias_checkpoint = set(dias_checkpoint or [])
+        self.checkpoints = getattr(self, "checkpoints", {})
+        while self.dia < self.n_dias:
+            self.avanzar_dia()
+            if self.dia in dias_checkpoint:
+                self.checkpoints[self.dia] = self.checkpoint()
+        return self
+
+    def _generadores(self):
+        # Sin semilla todos los componentes comparten el generador global de NumPy
+        return [self.rng_dia] + self.rngs_prod if self.semilla is not None else [np.random]
+
+    def checkpoint(self):
+        """Serializa el estado actual (arreglos + estado de los generadores) en un blob npz comprimido."""
+        arreglos = {campo: getattr(self, campo) for campo in self.CAMPOS_ESTADO}
+        arreglos.update({campo: getattr(self.libro, campo) for campo in LibroPresupuesto.CAMPOS_ESTADO})
+        arreglos["movimientos"] = self.libro.movimientos()
+        arreglos["historia"] = self.historia[:, :self.dia]
+        for g, (_, _, menu) in enumerate(self.menus):
+            sufijo = f"_{g}" if g else ""
+            arreglos["menu_indices" + sufijo] = menu.indices
+            arreglos["menu_pcts" + sufijo] = menu.pcts
+            arreglos["menu_reposicion" + sufijo] = menu.reposicion
+
+        rngs = []
+        for k, rng in enumerate(self._generadores()):
+            nombre, clave, pos, tiene_gauss, gauss = rng.get_state()
+            arreglos[f"rng_{k}"] = clave
+            rngs.append([nombre, int(pos), int(tiene_gauss), float(gauss)])
+
+        meta = {
+            "version": 1, "dia": self.dia, "quincena": self.libro.quincena, "n_dias": self.n_dias,
+            "politica": self.libro.politica,
+            "semilla": self.semilla, "almacen_compartido": self.almacen_compartido,
+            "presupuesto_compartido": self.presupuesto_compartido,
+            "productos": self.catalogo["nombre"], "n_sedes": len(self.sedes),
+            "logs": self.logs, "rngs": rngs,
+            "menus": [{"sedes": sedes_menu.tolist(), "reglas": reglas} for sedes_menu, reglas, _ in self.menus],
+        }
+        arreglos["meta"] = np.array(json.dumps(meta))
+
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arreglos)
+        return buffer.getvalue()
+
+    @staticmethod
+    def meta_checkpoint(estado):
+        """Metadatos de un checkpoint (día, semilla, modo de compartición, menús...) sin cargar sus arreglos."""
+        return json.loads(str(np.load(io.BytesIO(estado), allow_pickle=False)["meta"]))
+
+    @classmethod
+    def desde_checkpoint(cls, estado, sedes, politica=None):
+        """
+        Reconstruye un motor en el día del checkpoint con la configuración de sedes dada, que
+        puede diferir de la original (límites, ratios, Max_Stock, tope, población y calendario
+        para los días restantes), igual que la política de presupuesto (por omisión la del
+        checkpoint). El menú del año ya sorteado se conserva del checkpoint, así que deben
+        coincidir las reglas de menú de cada sede, el número de sedes y los productos del catálogo.
+        """
+        datos = np.load(io.BytesIO(estado), allow_pickle=False)
+        meta = json.loads(str(datos["meta"]))
+        if len(sedes) != meta["n_sedes"]:
+            raise ValueError(f"El checkpoint tiene {meta['n_sedes']} sedes y se recibieron {len(sedes)}")
+
+        motor = cls(sedes, meta["semilla"], meta["almacen_compartido"], meta["presupuesto_compartido"], meta["n_dias"],
+                    politica or meta.get("politica", "prioridad"))
+        if motor.catalogo["nombre"] != meta["productos"]:
+            raise ValueError("El catálogo cambió de productos desde que se tomó el checkpoint")
+        menus = meta.get("menus") or [{"sedes": list(range(meta["n_sedes"])), "reglas": REGLAS_MENU}]
+        reglas_sede = {s: json.dumps(m["reglas"], sort_keys=True) for m in menus for s in m["sedes"]}
+        for s, sede in enumerate(motor.sedes):
+            if json.dumps(sede["reglas_menu"] or REGLAS_MENU, sort_keys=True) != reglas_sede[s]:
+                raise ValueError(f"Las reglas de menú de la sede {sede['nombre']} no coinciden con las del checkpoint")
+
+        for campo in cls.CAMPOS_ESTADO:
+            setattr(motor, campo, datos[campo].copy())
+        for campo in LibroPresupuesto.CAMPOS_ESTADO:
+            setattr(motor.libro, campo, datos[campo].copy())
+        if "movimientos" in datos.files: motor.libro.lotes = [datos["movimientos"]]
+        motor.historia[:, :meta["dia"]] = datos["historia"]
+        motor.menus = []
+        for g, m in enumerate(menus):
+            sufijo = f"_{g}" if g else ""
+            menu = GeneradorMenu(motor.catalogo["nombre"], motor.catalogo["categoria"], m["reglas"])
+            menu.indices, menu.pcts, menu.reposicion = datos["menu_indices" + sufijo], datos["menu_pcts" + sufijo], datos["menu_reposicion" + sufijo]
+            motor.menus.append((np.array(m["sedes"], dtype=np.intp), m["reglas"], menu))
+        motor.demanda = motor._calcular_demanda()
+        motor.dia, motor.logs = meta["dia"], meta["logs"]
+        motor.libro.dia, motor.libro.quincena = meta["dia"], meta["quincena"]
+
+        for k, (rng, (nombre, pos, tiene_gauss, gauss)) in enumerate(zip(motor._generadores(), meta["rngs"])):
+            rng.set_state((nombre, datos[f"rng_{k}"], pos, tiene_gauss, gauss))
+        return motor
+
+    def resultado_sede(self, s):
+        """Devuelve (productos, quincenas, log, limites, gasto_anual, metricas) de una sede."""
+        sede, f, cat = self.sedes[s], self.fila_sede[s], self.catalogo
+        # Con almacén compartido el gasto se reparte según el valor consumido por cada sede
+        fraccion = 1.0
+        if self.almacen_compartido:
+            total = self.valor_servido.sum()
+            fraccion = self.valor_servido[s] / total if total > 0 else 1.0 / len(self.sedes)
+
+        productos = []
+        for j, item in enumerate(cat["registros"]):
+            p = AlmacenProducto(item, sede["config_almacen"], self.ratio[f, j])
+            p.max_stock = float(self.max_stock[f, j])
+            p.stock = float(self.stock[f, j])
+            p.historia_stock = self.historia[f, :self.dia, j].tolist()
+            pendientes = np.nonzero(self.llegadas[f, j, self.dia + 1:])[0] + self.dia + 1
+            p.pedidos_en_camino = [(int(dl), float(self.llegadas[f, j, dl]), float(self.llegadas[f, j, dl] * p.precio)) for dl in pendientes]
+            productos.append(p)
+
+        quincenas = {q + 1: float(v * fraccion) for q, v in enumerate(self.libro.quincenas_fila[f])}
+        gasto_anual = {c: float(v * fraccion) for c, v in zip(self.categorias, self.libro.gasto_fila_cat[f])}
+        limites = {c: float(v) for c, v in zip(self.categorias, self.limites_sede[s])}
+        metricas = resumir_metricas(cat["nombre"], cat["categoria"], self.categorias,
+                                    self.demanda_unidades[s], self.insatisfecha[s], self.dias_quiebre[s],
+                                    self.dias_quiebre_cat[s], self.cobertura_acum[s] / max(self.dia, 1))
+        return productos, quincenas, list(self.logs[f]), limites, gasto_anual, metricas
+
+def correr_simulacion_manual(poblacion_input, limites_anuales=None, ratios_objetivo=None, semilla=None,
+                             politica="prioridad", reglas_menu=None):
+    sede = {"poblacion": poblacion_input, "limites_anuales": limites_anuales, "ratios_objetivo": ratios_objetivo,
+            "reglas_menu": reglas_menu}
+    return MotorSimulacion([sede], semilla=semilla, politica=politica).correr().resultado_sede(0)
+
+def correr_simulacion_multisede(sedes, semilla=None, almacen_compartido=False, presupuesto_compartido=False,
+                                politica="prioridad"):
+    motor = MotorSimulacion(sedes, semilla, almacen_compartido, presupuesto_compartido, politica=politica).correr()
+    return [motor.resultado_sede(s) for s in range(len(sedes))]
+
+def reanudar_simulacion(estado, sedes, politica=None):
+    """Continúa una rama what-if desde un checkpoint y devuelve el resultado de cada sede."""
+    motor = MotorSimulacion.desde_checkpoint(estado, sedes, politica).correr()
+    return [motor.resultado_sede(s) for s in range(len(sedes))]
 
-        deficit = stock_objetivo - (self.stock + en_camino)
+# ==============================================================================
+# BLOQUE 3.1: OPTIMIZADOR DE PRESUPUESTO
+# ==============================================================================
+# Cada quincena que rebasa el tope cuenta como esta cantidad de días de quiebre
+PENALIZACION_TOPE = 30
+
+def evaluar_candidato(poblacion, limites, ratios, semilla):
+    _, quincenas, _, _, _, metricas = correr_simulacion_manual(poblacion, limites, ratios, semilla)
+    excesos = sum(1 for val in quincenas.values() if clasificar_quincena(val) == "ERROR CRÍTICO")
+    return int(metricas["producto"]["dias_quiebre"].sum()) + PENALIZACION_TOPE * excesos
+
+def generar_candidato(rng, limites_base, ratios_base, concentracion=200.0, dispersion_ratio=0.10):
+    # Reparte el mismo total anual entre categorías y perturba los niveles de reorden
+    cats = list(limites_base)
+    total = sum(limites_base.values())
+    cuotas_base = np.array([limites_base[c] for c in cats]) / total
+    cuotas = rng.dirichlet(cuotas_base * concentracion)
+    limites = {c: float(total * q) for c, q in zip(cats, cuotas)}
+    ratios = {c: float(np.clip(ratios_base[c] + rng.normal(0, dispersion_ratio), 0.10, 0.90)) for c in ratios_base}
+    return limites, ratios
+
+def optimizar_presupuesto(poblacion, n_candidatos=24, replicas_max=10, replicas_iniciales=3,
+                          semilla=2025, procesos=None, z_descarte=2.0):
+    """
+    Busca límites anuales por categoría y ratios de reorden que minimicen los días de quiebre.
+    Todos los candidatos se evalúan con las mismas semillas (números aleatorios comunes), y tras
+    cada réplica se descartan los que son peores que el líder por más de z_descarte errores
+    estándar de la diferencia pareada. procesos=1 evalúa en el proceso actual.
+    """
+    rng = np.random.RandomState(semilla)
+    limites_base = {cat: conf["Ref_Gasto_3M"] * 4 for cat, conf in CONFIG_ALMACEN.items()}
+    ratios_base = {cat: ratio_objetivo_base(cat) for cat in CONFIG_ALMACEN}
+    candidatos = [(limites_base, ratios_base)]
+    candidatos += [generar_candidato(rng, limites_base, ratios_base) for _ in range(n_candidatos - 1)]
+
+    semillas_crn = [semilla + 1 + r for r in range(replicas_max)]
+    puntajes = np.full((len(candidatos), replicas_max), np.nan)
+    vivos = list(range(len(candidatos)))
+    hechas = 0
+
+    pool = ProcessPoolExecutor(max_workers=procesos) if procesos != 1 else None
+    mapear = pool.map if pool else map
+    try:
+        while hechas < replicas_max and (len(vivos) > 1 or hechas == 0):
+            lote = range(hechas, min(replicas_max, max(replicas_iniciales, hechas + 1)))
+            tareas = [(i, r) for i in vivos for r in lote]
+            resultados = mapear(evaluar_candidato,
+                                [poblacion] * len(tareas),
+                                [candidatos[i][0] for i, _ in tareas],
+                                [candidatos[i][1] for i, _ in tareas],
+                                [semillas_crn[r] for _, r in tareas])
+            for (i, r), val in zip(tareas, resultados):
+                puntajes[i, r] = val
+            hechas = lote.stop
+
+            bloque = puntajes[vivos, :hechas]
+            mejor = vivos[int(np.argmin(bloque.mean(axis=1)))]
+            if hechas > 1:
+                dif = bloque - puntajes[mejor, :hechas]
+                error = dif.std(axis=1, ddof=1) / np.sqrt(hechas)
+                vivos = [i for i, d, e in zip(vivos, dif.mean(axis=1), error) if d - z_descarte * e <= 0]
+    finally:
+        if pool: pool.shutdown()
+
+    medias = np.nanmean(puntajes, axis=1)
+    mejor = min(vivos, key=lambda i: medias[i])
+    return {
+        "limites": candidatos[mejor][0],
+        "ratios": candidatos[mejor][1],
+        "puntaje": float(medias[mejor]),
+        "puntaje_base": float(medias[0]),
+        "replicas": hechas,
+        "evaluaciones": int(np.isfinite(puntajes).sum()),
+        "finalistas": len(vivos),
+    }
 
-        if deficit > 0:
-            cant_real = deficit
-            costo_teorico = cant_real * self.precio
+# ==============================================================================
+# BLOQUE 3.2: COMPARACIÓN ESTADÍSTICA DE SIMULACIONES GUARDADAS
+# ==============================================================================
+def comparar_grupos(db, grupos, percentiles=(5, 50, 95)):
+    """
+    Compara grupos de simulaciones guardadas ({nombre: [ids]}); el primero es la referencia.
+    Gasto por categoría y excesos del tope quincenal se agregan en SQL; los percentiles de stock
+    se calculan con NumPy sobre las historias binarias de todas las réplicas a la vez.
+    """
+    nombres = list(grupos)
+    if len(nombres) < 2: raise ValueError("Se requieren al menos dos grupos para comparar")
+    for nombre in nombres:
+        if not grupos[nombre]: raise ValueError(f"El grupo {nombre} no tiene simulaciones")
+    faltantes = db.ids_inexistentes(sorted({i for ids in grupos.values() for i in ids}))
+    if faltantes: raise ValueError(f"No existen las simulaciones: {faltantes}")
+    ref = nombres[0]
+
+    # --- Gasto por categoría: media, desviación y diferencia contra la referencia ---
+    gasto = {}
+    for nombre in nombres:
+        for cat, n, media, media_cuad in db.agregados_categoria(grupos[nombre]):
+            desv = np.sqrt(max(media_cuad - media ** 2, 0.0) * n / (n - 1)) if n > 1 else 0.0
+            gasto.setdefault(cat, {})[nombre] = {"n": n, "media": media, "desv": float(desv)}
+    categorias = []
+    for cat in [c for c in CONFIG_ALMACEN if c in gasto] + [c for c in gasto if c not in CONFIG_ALMACEN]:
+        fila = {"categoria": cat, "grupos": gasto[cat], "diferencia": {}, "error": {}}
+        r = gasto[cat].get(ref)
+        for nombre in nombres[1:]:
+            g = gasto[cat].get(nombre)
+            if r is None or g is None: continue
+            fila["diferencia"][nombre] = g["media"] - r["media"]
+            fila["error"][nombre] = float(np.sqrt(g["desv"] ** 2 / g["n"] + r["desv"] ** 2 / r["n"]))
+        categorias.append(fila)
+
+    # --- Frecuencia de excesos del tope quincenal ---
+    quincenas = {}
+    for nombre in nombres:
+        filas = np.array([row[1:] for row in db.excesos_quincena(grupos[nombre], TOLERANCIA_TOPE)], dtype=float).reshape(-1, 2)
+        total, excesos = filas.sum(axis=0) if len(filas) else (0.0, 0.0)
+        quincenas[nombre] = {
+            "frecuencia": float(excesos / total) if total else 0.0,
+            "simulaciones_con_exceso": float((filas[:, 1] > 0).mean()) if len(filas) else 0.0,
+        }
+    for nombre in nombres[1:]:
+        quincenas[nombre]["diferencia"] = quincenas[nombre]["frecuencia"] - quincenas[ref]["frecuencia"]
+
+    # --- Percentiles de stock por producto (todas las réplicas y días de cada grupo) ---
+    historias = {nombre: db.historias_por_producto(grupos[nombre]) for nombre in nombres}
+    comunes = sorted(set.intersection(*(set(h) for h in historias.values())))
+    pct_grupo, cero_grupo = {}, {}
+    for nombre in nombres:
+        matrices = [historias[nombre][p].reshape(-1) for p in comunes]
+        if len({m.size for m in matrices}) == 1:
+            bloque = np.stack(matrices)
+            pct_grupo[nombre] = np.percentile(bloque, percentiles, axis=1)
+            cero_grupo[nombre] = (bloque <= 0).mean(axis=1)
+        else:
+            # Productos con distinto número de réplicas (el catálogo cambió entre simulaciones)
+            pct_grupo[nombre] = np.array([np.percentile(m, percentiles) for m in matrices]).T
+            cero_grupo[nombre] = np.array([(m <= 0).mean() for m in matrices])
 
-            if costo_teorico > limite_dinero:
-                cant_real = limite_dinero // self.precio
+    stock = []
+    for i, producto in enumerate(comunes):
+        fila = {"producto": producto, "percentiles": list(percentiles), "grupos": {}, "diferencia": {}}
+        for nombre in nombres:
+            fila["grupos"][nombre] = {"percentiles": pct_grupo[nombre][:, i].tolist(), "dias_en_cero": float(cero_grupo[nombre][i])}
+        for nombre in nombres[1:]:
+            fila["diferencia"][nombre] = (pct_grupo[nombre][:, i] - pct_grupo[ref][:, i]).tolist()
+        stock.append(fila)
 
-            if cant_real < 1: return 0, ""
+    return {"referencia": ref, "grupos": {n: list(grupos[n]) for n in nombres},
+            "categorias": categorias, "quincenas": quincenas, "stock": stock}
 
-            if tipo_pedido == 'RELLENO' and (cant_real * 1.1 * self.precio) <= limite_dinero:
-                 cant_real = int(cant_real * 1.1)
+def grupos_por_poblacion(db, poblaciones):
+    return {f"P{p}": db.ids_por_poblacion(p) for p in poblaciones}
 
-            if cant_real >= 1:
-                costo_real = cant_real * self.precio
-                dias_demora = 0
-                if self.categoria in ["CARNES", "POLLO", "VEGETALES", "GRANOS", "PASTAS"]:
-                    dias_demora = np.random.randint(2, 7)
+# ==============================================================================
+# BLOQUE 3.3: SERVICIO HTTP/JSON LOCAL
+# ==============================================================================
+# Tope de corridas por trabajo (sedes de una simulación o réplicas de un barrido)
+MAX_CORRIDAS_TRABAJO = 1000
+
+def validar_trabajo(tipo, parametros):
+    """Normaliza y valida los parámetros de un trabajo; lanza ValueError si no son válidos."""
+    if not isinstance(parametros, dict): raise ValueError("Los parámetros deben ser un objeto JSON")
+    semilla = parametros.get("semilla")
+    if semilla is not None and (not isinstance(semilla, int) or isinstance(semilla, bool) or semilla < 0):
+        raise ValueError("La semilla debe ser un entero no negativo")
+    politica = parametros.get("politica", "prioridad")
+    if politica not in POLITICAS_PRESUPUESTO:
+        raise ValueError(f"Política de presupuesto desconocida: {politica}")
+
+    dias_checkpoint = parametros.get("dias_checkpoint")
+    if dias_checkpoint is not None:
+        if not isinstance(dias_checkpoint, list) or not all(
+                isinstance(d, int) and not isinstance(d, bool) and 1 <= d < 365 for d in dias_checkpoint):
+            raise ValueError("dias_checkpoint debe ser una lista de días entre 1 y 364")
+        dias_checkpoint = sorted(set(dias_checkpoint)) or None
+
+    if tipo == "simulacion" and "sedes" in parametros:
+        sedes = parametros["sedes"]
+        if not isinstance(sedes, list) or not sedes: raise ValueError("Se requiere una lista con al menos una sede")
+        if len(sedes) > MAX_CORRIDAS_TRABAJO:
+            raise ValueError(f"Una simulación admite hasta {MAX_CORRIDAS_TRABAJO} sedes")
+        for sede in sedes:
+            if not isinstance(sede, dict): raise ValueError("Cada sede debe ser un objeto JSON")
+            normalizar_sede(sede)
+        return {"sedes": sedes, "semilla": semilla, "politica": politica, "dias_checkpoint": dias_checkpoint,
+                "almacen_compartido": bool(parametros.get("almacen_compartido", False)),
+                "presupuesto_compartido": bool(parametros.get("presupuesto_compartido", False))}
+
+    if tipo == "simulacion":
+        sede = normalizar_sede({clave: parametros.get(clave) for clave in
+                                ("poblacion", "limites_anuales", "ratios_objetivo", "reglas_menu")})
+        return {"poblacion": sede["poblacion"], "semilla": semilla, "politica": politica,
+                "reglas_menu": sede["reglas_menu"], "dias_checkpoint": dias_checkpoint,
+                "limites_anuales": parametros.get("limites_anuales") and sede["limites_anuales"],
+                "ratios_objetivo": sede["ratios_objetivo"] or None}
+
+    if tipo == "barrido":
+        poblaciones = parametros.get("poblaciones", [])
+        if not isinstance(poblaciones, list) or not all(es_numero(p) for p in poblaciones):
+            raise ValueError("poblaciones debe ser una lista de números")
+        poblaciones = [int(p) for p in poblaciones]
+        replicas = parametros.get("replicas", 1)
+        if not isinstance(replicas, int) or isinstance(replicas, bool):
+            raise ValueError("replicas debe ser un entero")
+        if not poblaciones or min(poblaciones) <= 0: raise ValueError("Se requieren poblaciones mayores a 0")
+        if replicas < 1 or len(poblaciones) * replicas > MAX_CORRIDAS_TRABAJO:
+            raise ValueError(f"Un barrido admite entre 1 y {MAX_CORRIDAS_TRABAJO} corridas")
+        return {"poblaciones": poblaciones, "replicas": replicas, "semilla": semilla, "politica": politica}
+
+    if tipo == "reanudacion":
+        checkpoint_id, sedes = parametros.get("checkpoint_id"), parametros.get("sedes")
+        if not isinstance(checkpoint_id, int) or isinstance(checkpoint_id, bool) or checkpoint_id < 1:
+            raise ValueError("checkpoint_id debe ser un entero mayor a 0")
+        if sedes is not None:
+            if not isinstance(sedes, list) or not sedes or len(sedes) > MAX_CORRIDAS_TRABAJO:
+                raise ValueError(f"sedes debe ser una lista de 1 a {MAX_CORRIDAS_TRABAJO} sedes")
+            for sede in sedes:
+                if not isinstance(sede, dict): raise ValueError("Cada sede debe ser un objeto JSON")
+                normalizar_sede(sede)
+        return {"checkpoint_id": checkpoint_id, "sedes": sedes, "politica": parametros.get("politica")}
+
+    if tipo == "optimizacion":
+        poblacion = normalizar_sede({"poblacion": parametros.get("poblacion")})["poblacion"]
+        n_candidatos, replicas_max = parametros.get("n_candidatos", 24), parametros.get("replicas_max", 10)
+        for clave, valor in (("n_candidatos", n_candidatos), ("replicas_max", replicas_max)):
+            if not isinstance(valor, int) or isinstance(valor, bool) or valor < 1:
+                raise ValueError(f"{clave} debe ser un entero mayor a 0")
+        if n_candidatos * replicas_max > MAX_CORRIDAS_TRABAJO:
+            raise ValueError(f"Una optimización admite hasta {MAX_CORRIDAS_TRABAJO} evaluaciones (candidatos x réplicas)")
+        return {"poblacion": poblacion, "n_candidatos": n_candidatos, "replicas_max": replicas_max,
+                "semilla": 2025 if semilla is None else semilla}
+
+    if tipo == "replicas":
+        sede = normalizar_sede({clave: parametros.get(clave) for clave in
+                                ("poblacion", "limites_anuales", "ratios_objetivo")})
+        enteros = {clave: parametros.get(clave, omision) for clave, omision in
+                   (("replicas", None), ("lote", 250), ("almacen_id", None), ("capacidad", None))}
+        for clave, valor in enteros.items():
+            if valor is not None and (not isinstance(valor, int) or isinstance(valor, bool) or valor < 1):
+                raise ValueError(f"{clave} debe ser un entero mayor a 0")
+        if enteros["replicas"] is None: raise ValueError("Se requiere la cantidad de réplicas")
+        ruta = parametros.get("ruta")
+        if (enteros["almacen_id"] is None) == (ruta is None):
+            raise ValueError("Indique almacen_id (almacén existente) o ruta y capacidad (almacén nuevo)")
+        if ruta is not None:
+            if not isinstance(ruta, str) or not ruta or os.path.basename(ruta) != ruta:
+                raise ValueError("ruta debe ser un nombre de archivo, sin directorios")
+            if os.path.exists(ruta): raise ValueError(f"El archivo {ruta} ya existe")
+            if enteros["capacidad"] is None or enteros["capacidad"] < enteros["replicas"]:
+                raise ValueError("La capacidad del almacén nuevo debe alcanzar para las réplicas")
+        return {"poblacion": sede["poblacion"], "replicas": enteros["replicas"], "lote": enteros["lote"],
+                "semilla": semilla, "politica": politica, "almacen_id": enteros["almacen_id"], "ruta": ruta,
+                "capacidad": enteros["capacidad"],
+                "limites_anuales": parametros.get("limites_anuales") and sede["limites_anuales"],
+                "ratios_objetivo": sede["ratios_objetivo"] or None}
+
+    raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+
+def ejecutar_trabajo(tipo, parametros):
+    """
+    Corre un trabajo ya validado (en un proceso del pool). Devuelve (sedes, resultados,
+    checkpoints), con checkpoints {dia: estado} si el trabajo pidió dias_checkpoint.
+    """
+    if tipo == "simulacion" and "sedes" in parametros:
+        sedes = parametros["sedes"]
+        motor = MotorSimulacion(sedes, parametros["semilla"], parametros["almacen_compartido"],
+                                parametros["presupuesto_compartido"], politica=parametros["politica"])
+    elif tipo == "simulacion":
+        sedes = [{"poblacion": parametros["poblacion"], "limites_anuales": parametros["limites_anuales"],
+                  "ratios_objetivo": parametros["ratios_objetivo"], "reglas_menu": parametros.get("reglas_menu")}]
+        motor = MotorSimulacion(sedes, semilla=parametros["semilla"], politica=parametros["politica"])
+    else:
+        # Barrido: todas las réplicas de todas las poblaciones avanzan juntas en un solo motor
+        sedes = [{"nombre": f"P{p}-R{r + 1}", "poblacion": p}
+                 for p in parametros["poblaciones"] for r in range(parametros["replicas"])]
+        motor = MotorSimulacion(sedes, parametros["semilla"], politica=parametros["politica"])
+    motor.correr(parametros.get("dias_checkpoint"))
+    return sedes, [motor.resultado_sede(s) for s in range(len(sedes))], motor.checkpoints
+
+def ejecutar_replicas(db_name, parametros):
+    """Corre un trabajo de réplicas ya validado (en un proceso del pool): crea el almacén si hace falta y lo llena."""
+    db = GestorBD(db_name)
+    if parametros["almacen_id"] is None:
+        almacen = AlmacenResultados.crear(db, parametros["ruta"], parametros["capacidad"])
+    else:
+        almacen = AlmacenResultados(db, parametros["almacen_id"])
+    n_corridas = correr_replicas_almacen(almacen, parametros["poblacion"], parametros["replicas"], parametros["semilla"],
+                                         parametros["lote"], parametros["politica"], parametros["limites_anuales"],
+                                         parametros["ratios_objetivo"])
+    return {"almacen_id": almacen.id, "n_corridas": n_corridas}
+
+def ejecutar_optimizacion(parametros):
+    """
+    Corre un trabajo de optimización ya validado (en un proceso del pool, sin sub-pool) y simula
+    el mejor candidato para guardarlo. Devuelve (óptimo, resultado de su simulación).
+    """
+    optimo = optimizar_presupuesto(parametros["poblacion"], parametros["n_candidatos"], parametros["replicas_max"],
+                                   semilla=parametros["semilla"], procesos=1)
+    resultado = correr_simulacion_manual(parametros["poblacion"], optimo["limites"], optimo["ratios"], parametros["semilla"])
+    return optimo, resultado
+
+class ServicioSimulacion:
+    """
+    Cola persistente (tabla trabajos) atendida por un pool acotado de procesos. Los trabajos
+    idénticos que siguen activos se fusionan: la segunda solicitud recibe el id del primero.
+    """
+    def __init__(self, db, trabajadores=2, max_pendientes=100):
+        self.db = db
+        self.max_pendientes = max_pendientes
+        self.pool = ProcessPoolExecutor(max_workers=trabajadores)
+        self.cola = queue.Queue()
+        self.lock = threading.Lock()
+        self.activos = 0
+
+        for trabajo_id, tipo, parametros in self.db.reanudar_trabajos_pendientes():
+            self.activos += 1
+            self.cola.put((trabajo_id, tipo, parametros))
+
+        self.hilos = [threading.Thread(target=self._atender, daemon=True) for _ in range(trabajadores)]
+        for hilo in self.hilos: hilo.start()
+
+    def enviar(self, tipo, parametros):
+        """Encola un trabajo. Devuelve (id, fusionado); lanza RuntimeError si la cola está llena."""
+        parametros = validar_trabajo(tipo, parametros)
+        clave = hashlib.sha1(json.dumps([tipo, parametros], sort_keys=True).encode()).hexdigest()
+        with self.lock:
+            existente = self.db.buscar_trabajo_activo(clave)
+            if existente is not None: return existente, True
+            if self.activos >= self.max_pendientes:
+                raise RuntimeError("Cola de trabajos llena, intente más tarde")
+            trabajo_id = self.db.crear_trabajo(tipo, clave, parametros)
+            self.activos += 1
+        self.cola.put((trabajo_id, tipo, parametros))
+        return trabajo_id, False
+
+    def _atender(self):
+        while True:
+            trabajo_id, tipo, parametros = self.cola.get()
+            self.db.actualizar_trabajo(trabajo_id, "en_curso")
+            try:
+                if tipo == "replicas":
+                    resultado = self.pool.submit(ejecutar_replicas, self.db.db_name, parametros).result()
+                elif tipo == "optimizacion":
+                    optimo, simulacion = self.pool.submit(ejecutar_optimizacion, parametros).result()
+                    ids = self.db.guardar_simulaciones_lote([simulacion], [parametros["poblacion"]], ["Óptimo"])
+                    resultado = dict(optimo, simulaciones=ids)
+                elif tipo == "reanudacion":
+                    resultado = self._reanudar(parametros)
                 else:
-                    if tipo_pedido == 'MENSUAL':
-                        dias_demora = np.random.randint(15, 30)
+                    sedes, resultados, checkpoints = self.pool.submit(ejecutar_trabajo, tipo, parametros).result()
+                    if tipo == "simulacion" and "sedes" in parametros:
+                        resultado = self._guardar_corrida(sedes, resultados, parametros["almacen_compartido"],
+                                                          parametros["presupuesto_compartido"])
                     else:
-                        dias_demora = np.random.randint(7, 15)
-
-                dia_llegada = dia_actual + dias_demora
-                self.pedidos_en_camino.append((dia_llegada, cant_real, costo_real))
-
-                gasto_pedido = costo_real
-                tipo_lbl = "M" if tipo_pedido == 'MENSUAL' else ("Q" if tipo_pedido == 'QUINCENAL' else "R")
-
-                if gasto_pedido > 50 or self.prioridad == 'Critico':
-                    compra_msg = f"[Día {dia_actual}] PEDIDO({tipo_lbl}): {self.nombre:<20} | LLEGA: Día {dia_llegada} | ${gasto_pedido:,.2f}"
-
-        return gasto_pedido, compra_msg
-
-    def simular_consumo(self, platos_vendidos, pct_demanda=0.0):
-        consumo_real = 0
-        if pct_demanda > 0 and self.stock > 0:
-            consumo_teorico = (platos_vendidos * pct_demanda) * self.racion_base * np.random.normal(1, 0.05)
-            consumo_real = min(consumo_teorico, self.stock)
-            self.stock -= consumo_real
-        return consumo_real
-
-def correr_simulacion_manual(poblacion_input):
-    productos = [AlmacenProducto(item) for item in CATALOGO_MAESTRO]
-    prods_by_cat = {}
-    for p in productos:
-        if p.categoria not in prods_by_cat: prods_by_cat[p.categoria] = []
-        prods_by_cat[p.categoria].append(p)
-
-    quincenas_gasto = {i: 0 for i in range(1, 27)}
-    log_compras = []
-    limites_anuales = {cat: conf["Ref_Gasto_3M"] * 4 for cat, conf in CONFIG_ALMACEN.items()}
-    gasto_acumulado_anual = {cat: 0.0 for cat in CONFIG_ALMACEN}
-    limite_quincenal_base = 9999.00
-    presupuesto_quincena_actual = limite_quincenal_base
-    quincena_actual_idx = 1
-
-    idx_granos = 0
-    idx_pastas = 0
-    lista_granos = prods_by_cat.get('GRANOS', [])
-    lista_pastas = prods_by_cat.get('PASTAS', [])
-
-    for dia_anio in range(1, 366):
-        nueva_quincena = min(26, (dia_anio // 14) + 1)
-        if nueva_quincena > quincena_actual_idx:
-            quincena_actual_idx = nueva_quincena
-            presupuesto_quincena_actual = limite_quincenal_base
-
-        demanda_personas = obtener_demanda_calendario(dia_anio, poblacion_input)
-
-        for p in productos:
-            p.recibir_pedidos(dia_anio)
-
-        gasto_dia_total = 0
-        es_dia_quincenal = (dia_anio % 15 == 1)
-        es_dia_mensual   = (dia_anio % 30 == 1)
-
-        orden_compra = ["ARROZ", "GRANOS", "CARNES", "POLLO", "VEGETALES", "PASTAS", "CONDIMENTOS", "ENLATADOS", "DESAYUNO", "ALIMENTOS_SECO", "SNACKS", "BEBIDAS", "OTROS/DESECHABLES"]
-        productos_ordenados = sorted(productos, key=lambda x: orden_compra.index(x.categoria) if x.categoria in orden_compra else 99)
-
-        for p in productos_ordenados:
-            tipo_pedido = None
-            es_alta_rotacion = p.categoria in ["CARNES", "POLLO", "VEGETALES", "GRANOS", "PASTAS", "ARROZ"]
-
-            demanda_diaria = poblacion_input * 0.20 * p.racion_base
-            if demanda_diaria <= 0: demanda_diaria = 0.1
-            dias_cobertura_actual = p.stock / demanda_diaria
-
-            if es_alta_rotacion:
-                if es_dia_quincenal or dias_cobertura_actual < 5:
-                    tipo_pedido = 'QUINCENAL'
+                        nombres = [s["nombre"] for s in sedes] if tipo == "barrido" else None
+                        ids = self.db.guardar_simulaciones_lote(resultados, [s["poblacion"] for s in sedes], nombres)
+                        resultado = {"simulaciones": ids}
+                    if checkpoints:
+                        destino = ({"corrida_id": resultado["corrida_id"]} if "corrida_id" in resultado
+                                   else {"simulacion_id": resultado["simulaciones"][0]})
+                        resultado["checkpoints"] = self.db.guardar_checkpoints(sedes, checkpoints, **destino)
+                self.db.actualizar_trabajo(trabajo_id, "completado", resultado=resultado)
+            except Exception as e:
+                self.db.actualizar_trabajo(trabajo_id, "error", error=str(e))
+            finally:
+                with self.lock:
+                    self.activos -= 1
+                self.cola.task_done()
+
+    def _guardar_corrida(self, sedes, resultados, almacen_compartido, presupuesto_compartido):
+        corrida_id = self.db.guardar_corrida_multisede(sedes, resultados, almacen_compartido, presupuesto_compartido)
+        ids = [row[0] for row in self.db.obtener_corrida_multisede(corrida_id)]
+        return {"corrida_id": corrida_id, "simulaciones": ids}
+
+    def _reanudar(self, parametros):
+        """Continúa un checkpoint guardado (con sus sedes o las del trabajo) y guarda la rama como corrida nueva."""
+        checkpoint = self.db.obtener_checkpoint(parametros["checkpoint_id"])
+        if checkpoint is None: raise ValueError(f"No existe el checkpoint {parametros['checkpoint_id']}")
+        _, sedes_checkpoint, estado = checkpoint
+        sedes = parametros["sedes"] or sedes_checkpoint
+        resultados = self.pool.submit(reanudar_simulacion, estado, sedes, parametros["politica"]).result()
+        if len(sedes) > 1:
+            meta = MotorSimulacion.meta_checkpoint(estado)
+            return self._guardar_corrida(sedes, resultados, meta["almacen_compartido"], meta["presupuesto_compartido"])
+        sede = normalizar_sede(sedes[0])
+        return {"simulaciones": self.db.guardar_simulaciones_lote(resultados, [sede["poblacion"]], [sedes[0].get("nombre")],
+                                                                  [sede["limite_quincenal"]])}
+
+    def cerrar(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class ManejadorSimulacion(BaseHTTPRequestHandler):
+    """
+    POST /simulaciones              {"poblacion": ...} o {"sedes": [...], ...} -> {"trabajo_id", "fusionado"}
+                                    "dias_checkpoint": [d, ...] guarda el estado al cerrar esos días
+    POST /barridos                  {"poblaciones": [...], "replicas": n, "semilla": s}
+    POST /reanudaciones             {"checkpoint_id", "sedes" (opcional, por omisión las originales), "politica"}
+    POST /replicas                  {"poblacion", "replicas", "almacen_id"} o {..., "ruta", "capacidad"}
+                                    llena un AlmacenResultados; el resultado trae almacen_id
+    POST /optimizaciones            {"poblacion", "n_candidatos", "replicas_max", "semilla"} ver optimizar_presupuesto;
+                                    guarda el mejor candidato como simulación y el óptimo en el trabajo
+    GET  /trabajos/<id>             estado del trabajo
+    GET  /trabajos/<id>/resultado   resúmenes de sus simulaciones (NDJSON por chunks)
+    GET  /simulaciones/<id>         resumen de una simulación guardada
+    GET  /simulaciones/<id>/stock   historias de stock (NDJSON por chunks, un producto por línea)
+    GET  /comparar?ids=1,2 | ?grupos=1,2;3,4 | ?poblaciones=1000,2000   ver comparar_grupos
+    GET  /almacenes/<id>                                  índice de un AlmacenResultados
+    GET  /almacenes/<id>/productos/<nombre|índice>?percentiles=5,50,95   bandas y días en cero
+    GET  /almacenes/<id>/corridas/<r>      historia de una corrida (NDJSON, un producto por línea)
+    """
+    protocol_version = "HTTP/1.1"
+
+    def _responder_json(self, codigo, cuerpo):
+        datos = json.dumps(cuerpo).encode("utf-8")
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def _responder_stream(self, filas):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for fila in filas:
+            datos = (json.dumps(fila) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(datos):X}\r\n".encode() + datos + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _partes(self):
+        return [p for p in urlparse(self.path).path.split("/") if p]
+
+    def do_POST(self):
+        rutas = {"simulaciones": "simulacion", "barridos": "barrido", "replicas": "replicas",
+                 "optimizaciones": "optimizacion", "reanudaciones": "reanudacion"}
+        partes = self._partes()
+        if len(partes) != 1 or partes[0] not in rutas:
+            return self._responder_json(404, {"error": "Ruta no encontrada"})
+        try:
+            largo = int(self.headers.get("Content-Length", 0))
+            parametros = json.loads(self.rfile.read(largo) or b"{}")
+            if not isinstance(parametros, dict): raise ValueError("El cuerpo debe ser un objeto JSON")
+            trabajo_id, fusionado = self.server.servicio.enviar(rutas[partes[0]], parametros)
+        except (ValueError, TypeError, KeyError) as e:
+            return self._responder_json(400, {"error": str(e)})
+        except RuntimeError as e:
+            return self._responder_json(503, {"error": str(e)})
+        self._responder_json(202, {"trabajo_id": trabajo_id, "fusionado": fusionado})
+
+    def do_GET(self):
+        db = self.server.servicio.db
+        partes = self._partes()
+        if partes == ["comparar"]:
+            return self._comparar(db)
+        if len(partes) < 2 or not partes[1].isdigit():
+            return self._responder_json(404, {"error": "Ruta no encontrada"})
+        recurso, ident, resto = partes[0], int(partes[1]), partes[2:]
+
+        if recurso == "trabajos":
+            trabajo = db.obtener_trabajo(ident)
+            if trabajo is None: return self._responder_json(404, {"error": "Trabajo no encontrado"})
+            if not resto: return self._responder_json(200, trabajo)
+            if resto == ["resultado"]:
+                if trabajo["estado"] != "completado":
+                    return self._responder_json(409, {"error": f"Trabajo en estado {trabajo['estado']}"})
+                if "simulaciones" not in trabajo["resultado"]:
+                    return self._responder_json(200, trabajo["resultado"])
+                return self._responder_stream(db.obtener_resumen_simulacion(i) for i in trabajo["resultado"]["simulaciones"])
+
+        if recurso == "almacenes":
+            return self._almacen(db, ident, resto)
+
+        if recurso == "simulaciones":
+            resumen = db.obtener_resumen_simulacion(ident)
+            if resumen is None: return self._responder_json(404, {"error": "Simulación no encontrada"})
+            if not resto: return self._responder_json(200, resumen)
+            if resto == ["stock"]:
+                return self._responder_stream({"nombre": n, "categoria": c, "prioridad": p, "historia": h.tolist()}
+                                              for n, c, p, h in db.iterar_historias_stock(ident))
+
+        self._responder_json(404, {"error": "Ruta no encontrada"})
+
+    def _almacen(self, db, almacen_id, resto):
+        info = db.obtener_almacen_resultados(almacen_id)
+        if info is None: return self._responder_json(404, {"error": "Almacén no encontrado"})
+        if not resto: return self._responder_json(200, info)
+        if len(resto) != 2 or resto[0] not in ("productos", "corridas"):
+            return self._responder_json(404, {"error": "Ruta no encontrada"})
+        almacen = AlmacenResultados(db, almacen_id)
+        try:
+            if resto[0] == "corridas":
+                historia = almacen.corrida(int(resto[1]))
+                return self._responder_stream({"nombre": n, "historia": historia[:, j].tolist()}
+                                              for j, n in enumerate(almacen.productos))
+            producto = unquote(resto[1])
+            producto = int(producto) if producto.isdigit() else producto
+            consulta = parse_qs(urlparse(self.path).query)
+            percentiles = [float(p) for p in consulta.get("percentiles", ["5,50,95"])[0].split(",")]
+            bandas = almacen.bandas_producto(producto, percentiles)
+            en_cero = almacen.dias_en_cero(producto)
+        except ValueError as e:
+            return self._responder_json(400, {"error": str(e)})
+        self._responder_json(200, {"producto": almacen.productos[almacen._indice(producto)], "corridas": almacen.n_corridas,
+                                   "bandas": {f"p{p:g}": b.tolist() for p, b in zip(percentiles, bandas)},
+                                   "dias_en_cero": {"media": float(en_cero.mean()), "max": int(en_cero.max())}})
+
+    def _comparar(self, db):
+        consulta = parse_qs(urlparse(self.path).query)
+        try:
+            if "poblaciones" in consulta:
+                grupos = grupos_por_poblacion(db, [int(p) for p in consulta["poblaciones"][0].split(",")])
+            elif "grupos" in consulta:
+                grupos = {f"G{i + 1}": [int(x) for x in g.split(",")] for i, g in enumerate(consulta["grupos"][0].split(";"))}
             else:
-                if es_dia_mensual:
-                    tipo_pedido = 'MENSUAL'
-                elif dias_cobertura_actual < 10:
-                    tipo_pedido = 'RELLENO'
-
-            if tipo_pedido:
-                dinero_quincena = presupuesto_quincena_actual
-                limite_cat = limites_anuales.get(p.categoria, 999999)
-                gastado_cat = gasto_acumulado_anual.get(p.categoria, 0)
-                dinero_categoria = max(0, limite_cat - gastado_cat)
-                limite_final = min(dinero_quincena, dinero_categoria)
-
-                gasto, msg = p.realizar_pedido(dia_anio, tipo_pedido, limite_final, poblacion_input)
-
-                if gasto > 0:
-                    gasto_dia_total += gasto
-                    presupuesto_quincena_actual -= gasto
-                    gasto_acumulado_anual[p.categoria] += gasto
-                    if msg: log_compras.append(msg)
-
-        menu_del_dia = {}
-        if prods_by_cat.get('POLLO'): menu_del_dia[np.random.choice(prods_by_cat['POLLO'])] = 0.75
-        if prods_by_cat.get('CARNES'): menu_del_dia[np.random.choice(prods_by_cat['CARNES'])] = 0.75
-
-        if lista_granos:
-            grano_actual = lista_granos[idx_granos]
-            if grano_actual.stock <= 0:
-                gasto, msg = grano_actual.realizar_pedido(dia_anio, 'RELLENO', 500, poblacion_input)
-                if gasto > 0:
-                    gasto_dia_total += gasto
-                    presupuesto_quincena_actual -= gasto
-                    gasto_acumulado_anual[grano_actual.categoria] += gasto
-                    log_compras.append(msg + " (AGOTADO)")
-            menu_del_dia[grano_actual] = 1.0
-            idx_granos = (idx_granos + 1) % len(lista_granos)
-
-        if lista_pastas:
-            pasta_actual = lista_pastas[idx_pastas]
-            if pasta_actual.stock <= 0:
-                gasto, msg = pasta_actual.realizar_pedido(dia_anio, 'RELLENO', 500, poblacion_input)
-                if gasto > 0:
-                    gasto_dia_total += gasto
-                    presupuesto_quincena_actual -= gasto
-                    gasto_acumulado_anual[pasta_actual.categoria] += gasto
-                    log_compras.append(msg + " (AGOTADO)")
-            menu_del_dia[pasta_actual] = 0.33
-            idx_pastas = (idx_pastas + 1) % len(lista_pastas)
-
-        bebidas = prods_by_cat.get('BEBIDAS', [])
-        if len(bebidas) >= 3:
-            sel = np.random.choice(bebidas, 3, replace=False)
-            menu_del_dia[sel[0]] = 0.33; menu_del_dia[sel[1]] = 0.33; menu_del_dia[sel[2]] = 0.34
-
-        for arroz in prods_by_cat.get('ARROZ', []): menu_del_dia[arroz] = 1.0
-
-        cond = prods_by_cat.get('CONDIMENTOS', [])
-        fijos = [p for p in cond if any(x in p.nombre for x in ["SAL", "ACEITE", "AZUCAR"])]
-        vars_c = [p for p in cond if p not in fijos]
-        for p in fijos: menu_del_dia[p] = 1.0
-        if len(vars_c) >= 2:
-            for p in np.random.choice(vars_c, 2, replace=False): menu_del_dia[p] = 1.0
-
-        vegs = prods_by_cat.get('VEGETALES', [])
-        if len(vegs) >= 2:
-            for p in np.random.choice(vegs, 2, replace=False): menu_del_dia[p] = 1.0
-
-        pct_desayuno = np.random.uniform(0.10, 0.15)
-        for p in prods_by_cat.get('DESAYUNO', []): menu_del_dia[p] = pct_desayuno
-
-        for p in prods_by_cat.get('OTROS/DESECHABLES', []): menu_del_dia[p] = 1.0
-        for cat in ['SNACKS', 'ENLATADOS', 'ALIMENTOS_SECO']:
-            for p in prods_by_cat.get(cat, []): menu_del_dia[p] = 0.20
-
-        for p in productos:
-            pct = menu_del_dia.get(p, 0.0)
-            p.simular_consumo(demanda_personas, pct_demanda=pct)
-            p.historia_stock.append(p.stock)
+                grupos = {f"#{i}": [int(i)] for i in consulta.get("ids", [""])[0].split(",") if i}
+            self._responder_json(200, comparar_grupos(db, grupos))
+        except ValueError as e:
+            self._responder_json(400, {"error": str(e)})
+
+def iniciar_servidor(host="127.0.0.1", puerto=8765, trabajadores=2, max_pendientes=100, db_name="cafeteria_utpcrpo_v3.db"):
+    servidor = ThreadingHTTPServer((host, puerto), ManejadorSimulacion)
+    servidor.servicio = ServicioSimulacion(GestorBD(db_name), trabajadores, max_pendientes)
+    print(f"Servicio de simulación en http://{host}:{puerto}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        servidor.servicio.cerrar()
 
-        quincenas_gasto[quincena_actual_idx] += gasto_dia_total
-
-    return productos, quincenas_gasto, log_compras, limites_anuales, gasto_acumulado_anual
+# ==============================================================================
+# BLOQUE 3.4: ALMACÉN DE RESULTADOS MASIVOS (np.memmap)
+# ==============================================================================
+class AlmacenResultados:
+    """
+    Historias de stock de muchas réplicas en un archivo np.memmap float32 de forma
+    (productos, capacidad, n_dias), indexado en GestorBD. Así un producto en todas las corridas
+    es un bloque contiguo del archivo y una corrida son n_productos tramos de n_dias. El archivo
+    se crea disperso con toda la capacidad y solo crece por el final: reservar() aparta las filas
+    en GestorBD antes de entregar la vista que el motor llena (varios escritores nunca comparten
+    filas) y confirmar() registra el lote; lo no confirmado no se lee.
+    """
+    def __init__(self, db, almacen_id):
+        info = db.obtener_almacen_resultados(almacen_id)
+        if info is None: raise ValueError(f"No existe el almacén de resultados {almacen_id}")
+        self.db, self.id = db, almacen_id
+        self.ruta, self.capacidad, self.n_dias = info["ruta"], info["capacidad"], info["n_dias"]
+        self.productos, self.n_corridas = info["productos"], info["n_corridas"]
+        self.datos = np.memmap(self.ruta, dtype=np.float32, mode="r+", shape=(len(self.productos), self.capacidad, self.n_dias))
+
+    @classmethod
+    def crear(cls, db, ruta, capacidad, n_dias=365, productos=None):
+        if os.path.exists(ruta): raise ValueError(f"El archivo {ruta} ya existe")
+        productos = list(productos or CATALOGO.obtener()["nombre"])
+        np.memmap(ruta, dtype=np.float32, mode="w+", shape=(len(productos), capacidad, n_dias)).flush()
+        return cls(db, db.crear_almacen_resultados(ruta, capacidad, n_dias, productos))
+
+    def reservar(self, cantidad):
+        """(inicio, vista) de las próximas corridas; la vista tiene forma (cantidad, n_dias, productos)."""
+        inicio = self.db.reservar_corridas_almacen(self.id, cantidad)
+        return inicio, self.datos[:, inicio:inicio + cantidad].transpose(1, 2, 0)
+
+    def confirmar(self, inicio, cantidad, parametros):
+        self.datos.flush()
+        self.n_corridas = self.db.registrar_lote_almacen(self.id, inicio, cantidad, parametros)
+
+    def liberar(self, inicio, cantidad):
+        return self.db.liberar_corridas_almacen(self.id, inicio, cantidad)
+
+    def actualizar(self):
+        """Relee del índice cuántas corridas están confirmadas (otros escritores pudieron agregar)."""
+        self.n_corridas = self.db.obtener_almacen_resultados(self.id)["n_corridas"]
+        return self.n_corridas
+
+    def _indice(self, producto):
+        if isinstance(producto, str):
+            if producto not in self.productos: raise ValueError(f"Producto desconocido: {producto}")
+            return self.productos.index(producto)
+        if not 0 <= producto < len(self.productos): raise ValueError(f"Producto fuera de rango: {producto}")
+        return int(producto)
+
+    def producto(self, producto, corridas=slice(None)):
+        """Historias (corridas x días) de un producto (nombre o índice) como vista sobre el archivo."""
+        return self.datos[self._indice(producto), :self.n_corridas][corridas]
+
+    def corrida(self, r):
+        """Historia (días x productos) de una corrida."""
+        if not 0 <= r < self.n_corridas: raise ValueError(f"Corrida fuera de rango: {r}")
+        return np.array(self.datos[:, r].T)
+
+    def bandas_producto(self, producto, percentiles=(5, 50, 95)):
+        """Percentiles diarios del stock de un producto entre todas las corridas (percentiles x días)."""
+        if self.n_corridas == 0: raise ValueError("El almacén no tiene corridas")
+        return np.percentile(self.producto(producto), percentiles, axis=0)
+
+    def dias_en_cero(self, producto, lote=8192):
+        """Días con stock en cero de un producto en cada corrida, leyendo el archivo por lotes."""
+        historias = self.producto(producto)
+        return np.concatenate([(historias[i:i + lote] <= 0).sum(axis=1) for i in range(0, self.n_corridas, lote)]
+                              or [np.zeros(0, dtype=np.int64)])
+
+def correr_replicas_almacen(almacen, poblacion, n_replicas, semilla=None, lote=250, politica="prioridad",
+                            limites_anuales=None, ratios_objetivo=None):
+    """
+    Corre n_replicas de una sede en lotes de `lote` réplicas (cada lote es un MotorSimulacion
+    con una sede por réplica) que escriben su historia directo en el almacén. Todo el rango se
+    reserva antes de correr, así un almacén sin capacidad falla sin escribir nada; si un lote
+    falla se libera lo que quedaba sin confirmar. Con semilla, cada lote usa [semilla, inicio]
+    para que agregar réplicas después no repita las anteriores.
+    """
+    if CATALOGO.obtener()["nombre"] != almacen.productos:
+        raise ValueError("El catálogo no coincide con los productos del almacén")
+    if n_replicas < 1: raise ValueError("Se requiere al menos una réplica")
+    sede = {"poblacion": poblacion, "limites_anuales": limites_anuales, "ratios_objetivo": ratios_objetivo}
+    inicio, historia = almacen.reservar(n_replicas)
+    hechas = 0
+    try:
+        while hechas < n_replicas:
+            n = min(lote, n_replicas - hechas)
+            semilla_lote = None if semilla is None else [semilla, inicio + hechas]
+            MotorSimulacion([sede] * n, semilla_lote, n_dias=almacen.n_dias, politica=politica,
+                            historia=historia[hechas:hechas + n]).correr()
+            almacen.confirmar(inicio + hechas, n, dict(sede, semilla=semilla_lote, politica=politica))
+            hechas += n
+    except Exception:
+        almacen.liberar(inicio + hechas, n_replicas - hechas)
+        raise
+    return almacen.n_corridas
 
 # ==============================================================================
 # SECCIÓN 4: INTERFAZ GRÁFICA
@@ -542,7 +2413,7 @@ class App(ctk.CTk):
         # --- Sidebar ---
         self.sidebar_frame = ctk.CTkFrame(self, width=200, corner_radius=0, fg_color="#F8F9FA")
         self.sidebar_frame.grid(row=0, column=0, sticky="nsew")
-        self.sidebar_frame.grid_rowconfigure(5, weight=1)
+        self.sidebar_frame.grid_rowconfigure(6, weight=1)
 
         self.btn_menu = ctk.CTkButton(self.sidebar_frame, text="≡ Menu", fg_color="#5E81F4", height=40, width=140, corner_radius=10)
         self.btn_menu.grid(row=0, column=0, padx=20, pady=20, sticky="ew")
@@ -550,10 +2421,12 @@ class App(ctk.CTk):
         self.btn_home = self.crear_boton_sidebar("🏠 Home", 1, self.mostrar_home)
         self.btn_sim = self.crear_boton_sidebar("📈 Nueva Simulación", 2, self.mostrar_simulacion)
         self.btn_hist = self.crear_boton_sidebar("⇄ Historial", 3, self.mostrar_historial)
+        self.btn_comp = self.crear_boton_sidebar("⚖ Comparar", 4, self.mostrar_comparacion)
+        self.btn_replicas = self.crear_boton_sidebar("📦 Réplicas", 5, self.mostrar_replicas)
 
         self.btn_exit = ctk.CTkButton(self.sidebar_frame, text="Exit", fg_color="transparent", text_color="black",
                                       anchor="w", command=self.destroy)
-        self.btn_exit.grid(row=6, column=0, padx=20, pady=20, sticky="ew")
+        self.btn_exit.grid(row=7, column=0, padx=20, pady=20, sticky="ew")
 
         # --- Main Area ---
         self.main_frame = ctk.CTkFrame(self, corner_radius=0, fg_color="#F0F2F5")
@@ -699,12 +2572,13 @@ class App(ctk.CTk):
             messagebox.showerror("Error", "La población debe ser mayor a 0.")
             return
 
-        p, q, logs, lim_anual, gasto_anual = correr_simulacion_manual(poblacion)
+        p, q, logs, lim_anual, gasto_anual, metricas = correr_simulacion_manual(poblacion)
 
-        self.db.guardar_simulacion(gasto_anual, lim_anual, q, p, poblacion)
+        self.db.guardar_simulacion(gasto_anual, lim_anual, q, p, poblacion, metricas)
         messagebox.showinfo("Éxito", f"Simulación completada para {poblacion} personas.")
 
-        datos = {"gasto_anual": gasto_anual, "limites": lim_anual, "quincenas": q, "productos_obj": p}
+        datos = {"gasto_anual": gasto_anual, "limites": lim_anual, "quincenas": q, "productos_obj": p,
+                 "servicio": GestorBD.filas_servicio_categoria(metricas)}
         self.visualizar_resultados(self.resultados_frame, datos, modo="live")
 
     # ==========================================================================
@@ -726,13 +2600,14 @@ class App(ctk.CTk):
             ctk.CTkLabel(list_frame, text="Sin registros").pack()
 
         for row in rows:
-            sim_id, fecha, pob, total = row
+            sim_id, fecha, pob, total, sede = row
 
             # Frame contenedor de la fila
             row_frame = ctk.CTkFrame(list_frame, fg_color="transparent")
             row_frame.pack(fill="x", pady=2)
 
             txt = f"#{sim_id} | {fecha[:16]}\nPoblación: {pob} | Total: ${total:,.0f}"
+            if sede: txt = f"#{sim_id} | {sede} | {fecha[:16]}\nPoblación: {pob} | Total: ${total:,.0f}"
 
             # Botón Ver (Izquierda)
             btn_view = ctk.CTkButton(row_frame, text=txt, fg_color="white", text_color="black",
@@ -759,9 +2634,178 @@ class App(ctk.CTk):
     def cargar_historial_detalle(self, sim_id):
         for w in self.hist_detail_frame.winfo_children(): w.destroy()
         gasto, limites, quincenas, prods = self.db.obtener_simulacion_completa(sim_id)
-        datos = {"gasto_anual": gasto, "limites": limites, "quincenas": quincenas, "productos_obj": prods}
+        datos = {"gasto_anual": gasto, "limites": limites, "quincenas": quincenas, "productos_obj": prods,
+                 "servicio": self.db.obtener_metricas_categoria(sim_id), "tope": self.db.obtener_limite_quincenal(sim_id)}
         self.visualizar_resultados(self.hist_detail_frame, datos, modo="historia")
 
+    # ==========================================================================
+    # VISTA 4: COMPARACIÓN DE SIMULACIONES
+    # ==========================================================================
+    def mostrar_comparacion(self):
+        self.limpiar_contenido()
+        title = ctk.CTkLabel(self.content_area, text="COMPARACIÓN DE SIMULACIONES", font=("Arial", 16, "bold"), anchor="w")
+        title.pack(anchor="w", pady=(0, 20))
+
+        input_frame = ctk.CTkFrame(self.content_area, fg_color="white", corner_radius=10)
+        input_frame.pack(fill="x", pady=10)
+
+        self.modo_comparacion = ctk.CTkOptionMenu(input_frame, values=["IDs de simulación", "Poblaciones"], width=170)
+        self.modo_comparacion.pack(side="left", padx=20, pady=10)
+        self.entry_comparacion = ctk.CTkEntry(input_frame, placeholder_text="Ej: 3, 5 (el primero es la referencia)", width=280)
+        self.entry_comparacion.pack(side="left", padx=10)
+
+        btn_comp = ctk.CTkButton(input_frame, text="⚖ Comparar", fg_color="#2FA5FF",
+                                 command=self.ejecutar_comparacion, height=35)
+        btn_comp.pack(side="right", padx=20)
+
+        self.comparacion_frame = ctk.CTkFrame(self.content_area, fg_color="transparent")
+        self.comparacion_frame.pack(fill="both", expand=True)
+        ctk.CTkLabel(self.comparacion_frame, text="Ingrese dos o más IDs (o poblaciones para agrupar réplicas)...", text_color="gray").pack(pady=50)
+
+    def ejecutar_comparacion(self):
+        valores = [v.strip() for v in self.entry_comparacion.get().split(",") if v.strip()]
+        if len(valores) < 2 or not all(v.isdigit() for v in valores):
+            messagebox.showerror("Error", "Ingrese al menos dos números enteros separados por coma.")
+            return
+
+        if self.modo_comparacion.get() == "Poblaciones":
+            grupos = grupos_por_poblacion(self.db, [int(v) for v in valores])
+        else:
+            grupos = {f"#{v}": [int(v)] for v in valores}
+
+        try:
+            comp = comparar_grupos(self.db, grupos)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        self.visualizar_comparacion(comp)
+
+    def visualizar_comparacion(self, comp):
+        for w in self.comparacion_frame.winfo_children(): w.destroy()
+        nombres = list(comp["grupos"])
+        otros = nombres[1:]
+
+        tabview = ctk.CTkTabview(self.comparacion_frame)
+        tabview.pack(fill="both", expand=True, padx=10, pady=10)
+        tab_tabla = tabview.add("Diferencias")
+        tab_graf = tabview.add("Gráfica")
+
+        scroll_tablas = ctk.CTkScrollableFrame(tab_tabla, fg_color="transparent")
+        scroll_tablas.pack(fill="both", expand=True)
+
+        headers = ["Categoría"] + [f"{n} (media)" for n in nombres] + [f"Δ {n}" for n in otros]
+        self.crear_tabla_header(scroll_tablas, headers, "#008B9F")
+        row_idx = 1
+        for fila in comp["categorias"]:
+            medias = [f"${fila['grupos'][n]['media']:,.0f}" if n in fila["grupos"] else "-" for n in nombres]
+            difs = [f"{fila['diferencia'][n]:+,.0f} ± {fila['error'][n]:,.0f}" if n in fila["diferencia"] else "-" for n in otros]
+            self.crear_tabla_row(scroll_tablas, [fila["categoria"]] + medias + difs, row_idx)
+            row_idx += 1
+
+        ctk.CTkLabel(scroll_tablas, text="Excesos del tope quincenal", font=("Arial", 12, "bold")).grid(row=row_idx, column=0, columnspan=4, pady=10, sticky="w")
+        row_idx += 1
+        for n in nombres:
+            q = comp["quincenas"][n]
+            self.crear_tabla_row(scroll_tablas, [n, f"{q['frecuencia']:.1%} de quincenas", f"{q['simulaciones_con_exceso']:.0%} de simulaciones"], row_idx)
+            row_idx += 1
+
+        if otros and comp["stock"]:
+            ctk.CTkLabel(scroll_tablas, text=f"Mayores diferencias de stock mediano (P50) vs {comp['referencia']}", font=("Arial", 12, "bold")).grid(row=row_idx, column=0, columnspan=4, pady=10, sticky="w")
+            row_idx += 1
+            i_mediana = comp["stock"][0]["percentiles"].index(50) if 50 in comp["stock"][0]["percentiles"] else 0
+            top = sorted(comp["stock"], key=lambda f: -abs(f["diferencia"][otros[0]][i_mediana]))[:10]
+            for fila in top:
+                self.crear_tabla_row(scroll_tablas, [fila["producto"][:28]] +
+                                     [f"{fila['grupos'][n]['percentiles'][i_mediana]:,.1f}" for n in nombres] +
+                                     [f"{fila['diferencia'][n][i_mediana]:+,.1f}" for n in otros], row_idx)
+                row_idx += 1
+
+        fig, ax = plt.subplots(figsize=(6, 4), dpi=100)
+        fig.patch.set_facecolor('white')
+        cats = [f["categoria"] for f in comp["categorias"]]
+        x = np.arange(len(cats))
+        ancho = 0.8 / len(nombres)
+        for k, n in enumerate(nombres):
+            ax.bar(x + (k - (len(nombres) - 1) / 2) * ancho,
+                   [f["grupos"].get(n, {}).get("media", 0) for f in comp["categorias"]], ancho, label=n)
+        ax.set_xticks(x)
+        ax.set_xticklabels(cats, rotation=45, ha="right", fontsize=8)
+        ax.set_title("Gasto Medio por Categoría")
+        ax.yaxis.set_major_formatter(mtick.StrMethodFormatter('${x:,.0f}'))
+        ax.legend()
+        ax.grid(True, alpha=0.3)
+        sns.despine(ax=ax)
+        plt.tight_layout()
+        canvas = FigureCanvasTkAgg(fig, master=tab_graf)
+        canvas.get_tk_widget().pack(fill="both", expand=True, padx=10, pady=10)
+        canvas.draw()
+
+    # ==========================================================================
+    # VISTA 5: RÉPLICAS MASIVAS (AlmacenResultados)
+    # ==========================================================================
+    def mostrar_replicas(self):
+        self.limpiar_contenido()
+        title = ctk.CTkLabel(self.content_area, text="RÉPLICAS MASIVAS", font=("Arial", 16, "bold"), anchor="w")
+        title.pack(anchor="w", pady=(0, 20))
+
+        almacenes = self.db.listar_almacenes_resultados()
+        if not almacenes:
+            ctk.CTkLabel(self.content_area, text="No hay almacenes de réplicas (créelos con POST /replicas en el servicio)", text_color="gray").pack(pady=50)
+            return
+
+        input_frame = ctk.CTkFrame(self.content_area, fg_color="white", corner_radius=10)
+        input_frame.pack(fill="x", pady=10)
+
+        self.opciones_almacen = {f"#{a_id} | {fecha} | {n} corridas": a_id for a_id, fecha, n, _ in almacenes}
+        self.menu_almacen = ctk.CTkOptionMenu(input_frame, values=list(self.opciones_almacen), width=280,
+                                              command=lambda _: self.cargar_productos_almacen())
+        self.menu_almacen.pack(side="left", padx=20, pady=10)
+        self.menu_producto_almacen = ctk.CTkOptionMenu(input_frame, values=[""], width=260)
+        self.menu_producto_almacen.pack(side="left", padx=10)
+
+        btn = ctk.CTkButton(input_frame, text="📊 Graficar", fg_color="#2FA5FF", command=self.graficar_replicas, height=35)
+        btn.pack(side="right", padx=20)
+
+        self.replicas_frame = ctk.CTkFrame(self.content_area, fg_color="white", corner_radius=10)
+        self.replicas_frame.pack(fill="both", expand=True, pady=10)
+        self.cargar_productos_almacen()
+
+    def cargar_productos_almacen(self):
+        info = self.db.obtener_almacen_resultados(self.opciones_almacen[self.menu_almacen.get()])
+        self.menu_producto_almacen.configure(values=info["productos"])
+        self.menu_producto_almacen.set(info["productos"][0])
+
+    def graficar_replicas(self):
+        for w in self.replicas_frame.winfo_children(): w.destroy()
+        almacen = AlmacenResultados(self.db, self.opciones_almacen[self.menu_almacen.get()])
+        producto = self.menu_producto_almacen.get()
+        try:
+            # Solo se lee la rebanada del producto, nunca el arreglo completo
+            bandas = almacen.bandas_producto(producto, (5, 25, 50, 75, 95))
+            en_cero = almacen.dias_en_cero(producto)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+
+        fig, (ax, ax_hist) = plt.subplots(1, 2, figsize=(9, 4), dpi=100, gridspec_kw={"width_ratios": [3, 1]})
+        fig.patch.set_facecolor('white')
+        dias = np.arange(1, almacen.n_dias + 1)
+        ax.fill_between(dias, bandas[0], bandas[4], color='#2FA5FF', alpha=0.2, label='P5-P95')
+        ax.fill_between(dias, bandas[1], bandas[3], color='#2FA5FF', alpha=0.4, label='P25-P75')
+        ax.plot(dias, bandas[2], color='#008B9F', label='Mediana')
+        ax.set_title(f"{producto[:30]} ({almacen.n_corridas:,} corridas)")
+        ax.set_xlabel("Día")
+        ax.set_ylabel("Stock")
+        ax.legend()
+        ax.grid(True, alpha=0.3)
+        ax_hist.hist(en_cero, bins=20, color='#5E81F4')
+        ax_hist.set_title("Días en cero por corrida")
+        sns.despine(fig=fig)
+        plt.tight_layout()
+        canvas = FigureCanvasTkAgg(fig, master=self.replicas_frame)
+        canvas.get_tk_widget().pack(fill="both", expand=True, padx=10, pady=10)
+        canvas.draw()
+
     # ==========================================================================
     # VISUALIZACIÓN (TABLAS + GRÁFICAS)
     # ==========================================================================
@@ -796,11 +2840,19 @@ class App(ctk.CTk):
         ctk.CTkLabel(scroll_tablas, text="Quincenas (Primeras 8)", font=("Arial", 12, "bold")).grid(row=row_idx, column=0, pady=10, sticky="w")
         row_idx += 1
 
+        tope = datos.get("tope", LIMITE_QUINCENAL)
         for q, val in list(datos["quincenas"].items())[:8]:
-            alert = "CRÍTICO" if val > 9999 else "OK"
+            alert = clasificar_quincena(val, tope)
             self.crear_tabla_row(scroll_tablas, [f"Q{q}", f"${val:,.2f}", alert, ""], row_idx)
             row_idx += 1
 
+        if datos.get("servicio"):
+            ctk.CTkLabel(scroll_tablas, text="Nivel de Servicio (Días Quiebre | Fill Rate | Días Cobertura)", font=("Arial", 12, "bold")).grid(row=row_idx, column=0, columnspan=4, pady=10, sticky="w")
+            row_idx += 1
+            for cat, dias_quiebre, tasa, cobertura in datos["servicio"]:
+                self.crear_tabla_row(scroll_tablas, [cat, f"{dias_quiebre} días", f"{tasa:.1%}", f"{cobertura:,.1f} días"], row_idx)
+                row_idx += 1
+
         # --- GRÁFICAS ---
         ctrl_frame = ctk.CTkFrame(tab_graf, fg_color="transparent")
         ctrl_frame.pack(fill="x", pady=5)
@@ -841,7 +2893,8 @@ class App(ctk.CTk):
         elif opcion == "Flujo Quincenal":
             q = datos["quincenas"]
             ax.plot(list(q.keys()), list(q.values()), marker='o', color='#2FA5FF')
-            ax.axhline(9999, color='red', linestyle='--', label='Tope ($9,999)')
+            tope = datos.get("tope", LIMITE_QUINCENAL)
+            ax.axhline(tope, color='red', linestyle='--', label=f'Tope (${tope:,.0f})')
             ax.set_xlabel("Quincena")
             ax.set_ylabel("Gasto Acumulado ($)")
             ax.set_title("Flujo de Caja Quincenal")
@@ -880,5 +2933,8 @@ class App(ctk.CTk):
             ctk.CTkLabel(parent, text=v, fg_color="white", text_color="black").grid(row=r, column=i, padx=1, pady=1, sticky="ew")
 
 if __name__ == "__main__":
-    app = App()
-    app.mainloop()
\ No newline at end of file
+    if "--servidor" in sys.argv:
+        iniciar_servidor()
+    else:
+        app = App()
+        app.mainloop()
\ No newline at end of file